@@ -20,6 +20,7 @@
 # send_alerts   - send email alerts on any change [external supply, 100%, 10% and 0%]
 # read_interval - read battery voltage, ideally every 5 <= n <= 60 seconds
 # BATTERY_VMIN  - shutdown voltage
+# Stage timings are printed (to RR_BatMon.log) with: sudo kill -USR1 <pid>
 
 
 *** You may use/modify only for use with the RED REACTOR product
@@ -35,6 +36,9 @@ import socket
 import time  # Sleep between reading_interval
 
 from ina219 import INA219, DeviceRangeError  # This controls the battery monitoring IC
+from RR_Timing import timings, Ticker  # Stage timings, printed on SIGUSR1
+from RR_Watchdog import BoundedI2C, Watchdog, sd_notify  # Time limited reads, alert if readings stop
+from RR_I2CLock import i2c_lock  # Shares the I2C bus with other Red Reactor monitors
 
 # Constants - instead of command line args to keep it simple
 # Set to True to write all readings to log file, use as CSV data, else set to False
@@ -98,10 +102,11 @@ def send_email(smtp_message):
     try:
         # Note, check your SMTP server login requirements
         # print("Sending Email")
-        smtp_obj = smtplib.SMTP(smtp_host, smtp_port)
-        smtp_obj.starttls()
-        smtp_obj.login(smtp_username, smtp_password)
-        smtp_obj.sendmail(smtp_sender, smtp_receivers, message_template + smtp_message)
+        with timings.stage('send_email'):
+            smtp_obj = smtplib.SMTP(smtp_host, smtp_port)
+            smtp_obj.starttls()
+            smtp_obj.login(smtp_username, smtp_password)
+            smtp_obj.sendmail(smtp_sender, smtp_receivers, message_template + smtp_message)
         return True
     except (smtplib.SMTPException, socket.error) as email_error:
         if log_data:
@@ -112,11 +117,41 @@ def send_email(smtp_message):
 
 
 def write_log(bat_v, bat_i, bat_charge, bat_state):
-    with open(log_file, "a") as logfile:
+    with timings.stage('log_write'), open(log_file, "a") as logfile:
         logfile.write("{},{:.2f},{:.2f},{},{}\n".format(time.strftime("%H:%M:%S"),
                                                         bat_v, bat_i, bat_charge, bat_state))
 
 
+def read_error(i2c_error):
+    # Report a read that still fails after retries once, log every failure
+    global old_status
+    if old_status != 5:
+        old_status = 5
+        if send_alerts:
+            # Schedule resend if failed
+            if not send_email(message_error + str(i2c_error)):
+                old_status = -1
+        else:
+            print(message_error + str(i2c_error))
+    if log_data:
+        write_log(0, 0, 0, "READ ERROR: " + str(i2c_error))
+
+
+def connect():
+    # Reads that hang or fail are retried, re-opening the bus with this
+    rr_ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, busnum=1)
+    rr_ina.configure(rr_ina.RANGE_16V)
+    return rr_ina
+
+
+def stalled(seconds):
+    # Called by the watchdog thread, the shutdown check can't run without readings
+    if send_alerts:
+        send_email(message_error + "no battery reading for {:.0f}s".format(seconds))
+    else:
+        print(message_error + "no battery reading for {:.0f}s".format(seconds))
+
+
 # Clear log file with new header if required
 if log_data:
     with open(log_file, "w") as log:
@@ -125,8 +160,7 @@ if log_data:
 
 # Verify that RED REACTOR is attached
 try:
-    ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, busnum=1)
-    ina.configure(ina.RANGE_16V)
+    ina = BoundedI2C(connect)
 
 except OSError as error:
     if send_alerts:
@@ -138,7 +172,8 @@ except OSError as error:
                 socket.create_connection(("www.google.com", 80), timeout=3.1)
                 break
             except (OSError, TimeoutError, ConnectionError) as e:
-                # Short delay before trying again
+                # Short delay before trying again, keeping any systemd watchdog happy meanwhile
+                sd_notify("WATCHDOG=1")
                 time.sleep(2)
         send_email(message_error + str(error))
     else:
@@ -150,16 +185,38 @@ except OSError as error:
     exit(1)
 
 else:
+    # Print timings on demand, flushed as stdout is usually redirected to a file
+    timings.dump_on_signal(lambda report: print(report, flush=True))
+
+    # Read every read_interval seconds against fixed deadlines, a slow email doesn't shift later readings
+    ticker = Ticker(read_interval, 'sample')
+
+    # Emails (and stops systemd watchdog pings) if no good reading for several intervals
+    watchdog = Watchdog(read_interval, escalate=stalled)
+    watchdog.start()
+
     # Now loop until shutdown condition, only email on state changes
     while not shutdown:
 
-        volts = ina.voltage()
-        charge_level = int(max(min(100, (volts - BATTERY_VMIN) / (BATTERY_VMAX - BATTERY_VMIN) * 100), 0))
         try:
-            # <0 is charging, <10 is FULL, >10 is discharging
-            current = ina.current()
+            # One locked transaction, waking the device in case another monitor left it asleep
+            with i2c_lock, timings.stage('i2c_read'):
+                ina.wake()
+                volts = ina.voltage()
+                try:
+                    # <0 is charging, <10 is FULL, >10 is discharging
+                    current = ina.current()
+                    range_error = False
+                except DeviceRangeError:
+                    range_error = True
+        except OSError as error:
+            read_error(error)
+            ticker.wait()
+            continue
+        charge_level = int(max(min(100, (volts - BATTERY_VMIN) / (BATTERY_VMAX - BATTERY_VMIN) * 100), 0))
 
-        except DeviceRangeError as e:
+        if range_error:
+            timings.count('range_error')
             # Current out of device range with specified shunt resistor
             # Assume no ext power so it will still shutdown on low voltage reading
             external_power = False
@@ -186,6 +243,8 @@ else:
 
             message_text += "{}%".format(charge_level)
 
+        watchdog.kick()
+
         if charge_level <= 10 and not external_power:
             message_text = message_low
             new_status = 3
@@ -214,7 +273,7 @@ else:
 
         # Now wait till next reading
         if not shutdown:
-            time.sleep(read_interval)
+            ticker.wait()
 
     # Exit from while loop due to battery empty
     # Shutdown system
@@ -22,15 +22,23 @@
 # Import libraries
 from PyQt5.QtWidgets import QApplication, QSystemTrayIcon, QMenu, QAction, QMessageBox
 from PyQt5.QtGui import QIcon, QFont
-from PyQt5.QtCore import QTimer
+from PyQt5.QtCore import QTimer, Qt
 
 import logging
-import subprocess
 from os import system
 
 # Manage Battery readings and shutdown control
 import RR_BatMon
 
+# Cached CPU temperature and throttle status
+from RR_SysHealth import health, throttled_text
+
+# Stage timings, logged on SIGUSR1
+from RR_Timing import timings, Ticker
+
+# Shares the I2C bus with other Red Reactor monitors
+from RR_I2CLock import i2c_lock
+
 RR_Version = "1.0"
 
 
@@ -101,12 +109,17 @@ class TrayIcon(QSystemTrayIcon):
         self.countdown = 10
 
         self.timer = QTimer()
+        # Default coarse timers may fire up to 5% late
+        self.timer.setTimerType(Qt.PreciseTimer)
+        # Tracks how late each timer sample is against its schedule
+        self.ticker = Ticker(self.sample_timer / 1000, 'sample')
 
         # Configure the timer for taskbar report_update
         if self.battery is not None:
             # Set timer to call report_update every N x 1000 milliseconds
             self.timer.timeout.connect(self.report_update)
             self.timer.start(self.sample_timer)
+            self.ticker.reset()
             # Call update now to initialise icon
             self.report_update()
         else:
@@ -177,7 +190,7 @@ class TrayIcon(QSystemTrayIcon):
     def status_text(self):
         # Use dedicated pop-up so stay up and refresh at sample_interval
 
-        # Requires vcgencmd from OS, returns throttled=0x0 or
+        # Shared collector caches the throttle status, shown as throttled=0x0 or
         # 0x0 0001 - under-voltage
         # 0x0 0002 - currently throttled
         # 0x0 0004 - arm frequency capped
@@ -186,18 +199,10 @@ class TrayIcon(QSystemTrayIcon):
         # 0x2 0000 - throttling has occurred since last reboot
         # 0x4 0000 - arm frequency cap has occurred since last reboot
         # 0x8 0000 - soft temperature limit reached since last reboot
-
-        try:
-            cpu_data = subprocess.Popen(['vcgencmd', 'get_throttled'], stdout=subprocess.PIPE)
-            cpu_data = cpu_data.communicate()
-            cpu_status = cpu_data[0].decode().split("=")[1]
-            cpu_data = subprocess.Popen(['vcgencmd', 'measure_temp'], stdout=subprocess.PIPE)
-            cpu_data = cpu_data.communicate()
-            cpu_temp = cpu_data[0].decode().split("=")[1].rstrip()
-        except Exception:
-            # bypass if any failure
-            cpu_status = "Unknown"
-            cpu_temp = "Unknown"
+        with timings.stage('sys_health'):
+            temperature, throttled = health.read()
+        cpu_status = throttled_text(throttled) + "\n"
+        cpu_temp = "Unknown" if temperature is None else f"{temperature:.1f}'C"
 
         ext_power = "YES" if battery.current < 10 else "NO"
         bat_stat = "FAULT" if battery.battery_status == "FAULT" else ext_power
@@ -239,8 +244,15 @@ class TrayIcon(QSystemTrayIcon):
         Update samples and report status to screen
         """
 
+        if self.sender() is self.timer:
+            self.ticker.tick()
+        with timings.stage('report_update'):
+            self._report_update()
+
+    def _report_update(self):
         # Sample new values
-        battery.get_battery()
+        with i2c_lock, timings.stage('i2c_read'):
+            battery.get_battery()
         logger.debug(f"{battery.battery_status}, "
                      f"{battery.voltage:.2f}V, {battery.current:.2f}mA at {battery.battery_charge}%")
 
@@ -270,7 +282,7 @@ class TrayIcon(QSystemTrayIcon):
                 charges = config.getint('General', 'charge_cycles') + 1
                 logger.info(f'Charge Cycle incremented to {charges}')
                 config['General']['charge_cycles'] = str(charges)
-                with open(inifile, 'w') as cfg_file:
+                with timings.stage('config_write'), open(inifile, 'w') as cfg_file:
                     config.write(cfg_file)
             if battery.battery_status == "DISCHARGING" and self.track_notifications['LastState'] != 'DISCHARGING':
                 # Reset on-battery timer
@@ -489,6 +501,9 @@ if __name__ == '__main__':
         # Show the tray icon straight away
         trayIcon.show()
 
+    # Log stage timings with kill -USR1 <pid>, handled when the sample timer next runs
+    timings.dump_on_signal(lambda report: logger.info("\n" + report))
+
     # Run the app
     app.exec()
 
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Advisory lock so several Red Reactor monitors (and RR_Driver) can share the I2C bus
+
+# Hold the lock for a whole wake -> read -> sleep transaction:
+#   with i2c_lock:
+#       ina.wake(), ina.voltage(), ina.current(), ina.sleep()
+# Uses flock on LOCK_FILE, the same file is used by RR_Driver.cc
+# Time spent waiting is recorded as the i2c_lock_wait stage (RR_Timing), contended waits as i2c_lock_contended
+# If the lock is held for longer than LOCK_TIMEOUT (e.g. a hung client) the read goes ahead without it
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_I2CLock.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import fcntl
+import os
+import threading
+import time
+
+from RR_Timing import timings
+
+LOCK_FILE = "/run/lock/redreactor-i2c.lock"
+
+# Worst case of one RR_Watchdog BoundedI2C call on a failing bus, as its READ_TIMEOUT, RETRIES and BACKOFF:
+# every attempt and each bus re-open before a retry times out, plus the backoff between attempts
+I2C_READ_TIMEOUT = 0.5
+I2C_RETRIES = 2
+I2C_BACKOFF = 0.1
+I2C_WORST_CASE = (2 * I2C_RETRIES + 1) * I2C_READ_TIMEOUT + I2C_BACKOFF * (2 ** I2C_RETRIES - 1)
+
+# A transaction takes a few ms, the wait is bounded so a stuck client can't stop battery monitoring
+# Longer than a failing transaction, so a monitor doesn't go ahead unlocked just when the bus is in trouble
+LOCK_TIMEOUT = I2C_WORST_CASE + 1.0
+LOCK_POLL = 0.001
+
+
+class I2CLock:
+    """Cross-process (flock) and cross-thread lock for Red Reactor I2C transactions"""
+
+    def __init__(self, lock_file=LOCK_FILE, timeout=LOCK_TIMEOUT):
+        self.lock_file = lock_file
+        self.timeout = timeout
+        # flock is per open file, so threads of this process also need a thread lock
+        self.thread_lock = threading.Lock()
+        self.lock_fd = None
+        self.locked = False
+
+    def _open(self):
+        try:
+            self.lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o666)
+            # Allow other users' monitors to share the lock file, ignore if not the owner
+            try:
+                os.fchmod(self.lock_fd, 0o666)
+            except OSError:
+                pass
+        except OSError as error:
+            # Carry on without cross-process locking, e.g. no /run/lock
+            print("RR_I2CLock : Unable to open {}, not locking\nError: {}".format(self.lock_file, error))
+            self.lock_fd = -1
+
+    def __enter__(self):
+        start = time.perf_counter()
+        self.thread_lock.acquire()
+        if self.lock_fd is None:
+            self._open()
+        if self.lock_fd >= 0:
+            deadline = start + self.timeout
+            contended = False
+            while True:
+                try:
+                    fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.locked = True
+                    break
+                except BlockingIOError:
+                    contended = True
+                    if time.perf_counter() >= deadline:
+                        timings.count('i2c_lock_timeout')
+                        break
+                    time.sleep(LOCK_POLL)
+            if contended:
+                timings.count('i2c_lock_contended')
+        timings.observe('i2c_lock_wait', time.perf_counter() - start)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.locked:
+            fcntl.flock(self.lock_fd, fcntl.LOCK_UN)
+            self.locked = False
+        self.thread_lock.release()
+        return False
+
+
+# Shared lock for all users within the application
+i2c_lock = I2CLock()
+
+
+# Test contention between two processes
+if __name__ == "__main__":
+    import sys
+
+    test_lock = I2CLock(sys.argv[1] if len(sys.argv) > 1 else LOCK_FILE)
+    for transaction in range(200):
+        with test_lock:
+            # Similar to a wake, two reads and sleep
+            time.sleep(0.002)
+        time.sleep(0.003)
+    print(timings.report())
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Encodes and decodes the RR_MQTT Data topic payload, copy this file to use the decoder elsewhere
+
+# encode(data, 'json' | 'struct' | 'cbor' | 'msgpack') returns bytes, set with encoding: in config.yaml
+# decode(payload) returns the same dict as the JSON payload, whichever encoding was used
+# JSON payloads start with '{', binary payloads start with a format/version byte:
+#   0x01 struct: fixed little-endian layout, about 20 bytes instead of about 200
+#   0x04 struct with the window statistics (aggregate: true), 43 bytes
+#   0x02 cbor, 0x03 msgpack: map of field number to value (needs pip3 install cbor2 / msgpack)
+#   Messages sent late from the offline queue carry RR_TIME (epoch seconds of the reading), in binary payloads
+#   as TIMESTAMPED added to the format byte followed by a uint32
+# encode_samples()/decode_samples() pack the raw readings of a publish period for the Samples topic:
+#   0x11, base time (float64 epoch), count (uint16), then per reading the change in ms, mV and mA since the
+#   previous one as zigzag varints, typically 3-4 bytes a reading
+# encode_capture()/decode_capture() do the same for a burst capture (Capture topic), zlib compressed:
+#   0x21, start time (float64 epoch), rate (Hz, uint16), profile (index of CAPTURE_PROFILES), count (uint32),
+#   then the compressed changes in us, mV and mA
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Codec.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import json
+import struct
+import zlib
+
+# Optional encoders, only needed if selected
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Format/version byte at the start of binary payloads
+STRUCT_V1 = 0x01
+CBOR_V1 = 0x02
+MSGPACK_V1 = 0x03
+STRUCT_V2 = 0x04
+TIMESTAMPED = 0x80
+TIMESTAMP = struct.Struct("<I")
+SAMPLES_V1 = 0x11
+CAPTURE_V1 = 0x21
+
+# Data fields in wire order: name, struct format, scale (value * scale is sent as an integer)
+FIELDS = (("RR_volts", "H", 1000),
+          ("RR_current", "h", 1),
+          ("RR_charge", "B", 1),
+          ("RR_extpwr", "B", 1),
+          ("RR_CPUTEMP", "h", 10),
+          ("RR_CPUSTAT", "I", 1),
+          ("RR_WARN", "H", 10),
+          ("RR_VMIN", "H", 1000),
+          ("RR_INTERVAL", "H", 1))
+
+# Window statistics, added to the Data topic by aggregate: true
+WINDOW_FIELDS = (("RR_V_MIN", "H", 1000),
+                 ("RR_I_MIN", "h", 1),
+                 ("RR_I_MAX", "h", 1),
+                 ("RR_I_MEAN", "h", 1),
+                 ("RR_I_RMS", "H", 1),
+                 ("RR_WH", "i", 10000),
+                 ("RR_T_FULL", "H", 1),
+                 ("RR_T_CHARGING", "H", 1),
+                 ("RR_T_DISCHARGING", "H", 1),
+                 ("RR_WINDOW", "H", 1),
+                 ("RR_N", "H", 1))
+
+LAYOUTS = {STRUCT_V1: (FIELDS, struct.Struct("<B" + "".join(field[1] for field in FIELDS))),
+           STRUCT_V2: (FIELDS + WINDOW_FIELDS,
+                       struct.Struct("<B" + "".join(field[1] for field in FIELDS + WINDOW_FIELDS)))}
+
+SAMPLES_HEADER = struct.Struct("<BdH")
+MAX_SAMPLES = 0xFFFF
+
+CAPTURE_HEADER = struct.Struct("<BdHBI")
+# INA219 ADC resolution used for a capture, fewer bits convert faster
+CAPTURE_PROFILES = ("9bit", "10bit", "11bit", "12bit")
+
+# Integer range of each struct format, values outside it are clamped rather than failing the publish
+LIMITS = {"B": (0, 0xFF), "H": (0, 0xFFFF), "h": (-0x8000, 0x7FFF), "I": (0, 0xFFFFFFFF),
+          "i": (-0x80000000, 0x7FFFFFFF)}
+
+
+def available():
+    """Returns the encodings that can be used here"""
+    return ["json", "struct"] + (["cbor"] if cbor2 else []) + (["msgpack"] if msgpack else [])
+
+
+def _pack(value, format_char, scale):
+    low, high = LIMITS[format_char]
+    return max(low, min(high, int(round(value * scale))))
+
+
+def encode(data, encoding="json"):
+    """Encodes the Data topic dict, raises ValueError for an unknown or unavailable encoding"""
+    if encoding == "json":
+        return json.dumps(data).encode()
+    if encoding == "struct":
+        version = STRUCT_V2 if "RR_N" in data else STRUCT_V1
+        fields, layout = LAYOUTS[version]
+        return _timestamp(data, layout.pack(version, *(_pack(data.get(name, 0), format_char, scale)
+                                                       for name, format_char, scale in fields)))
+    # Field numbers instead of names keep the maps small
+    numbered = {number: data[name] for number, (name, format_char, scale) in enumerate(FIELDS + WINDOW_FIELDS)
+                if name in data}
+    if encoding == "cbor" and cbor2:
+        return _timestamp(data, bytes([CBOR_V1]) + cbor2.dumps(numbered))
+    if encoding == "msgpack" and msgpack:
+        return _timestamp(data, bytes([MSGPACK_V1]) + msgpack.packb(numbered))
+    raise ValueError("RR_Codec : encoding {} is not available, use one of {}".format(encoding, available()))
+
+
+def _timestamp(data, payload):
+    # Inserts RR_TIME after the format byte, if present
+    if "RR_TIME" not in data:
+        return payload
+    return bytes([payload[0] | TIMESTAMPED]) + TIMESTAMP.pack(int(data["RR_TIME"])) + payload[1:]
+
+
+def decode(payload):
+    """Decodes a Data topic payload (bytes or str) of any encoding into a dict, raises ValueError if not valid"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    if not payload:
+        raise ValueError("RR_Codec : empty payload")
+    if payload[:1] == b"{":
+        return json.loads(payload)
+    version = payload[0]
+    if version & TIMESTAMPED:
+        if len(payload) < 1 + TIMESTAMP.size:
+            raise ValueError("RR_Codec : truncated timestamp")
+        data = decode(bytes([version & ~TIMESTAMPED]) + payload[1 + TIMESTAMP.size:])
+        data["RR_TIME"] = TIMESTAMP.unpack_from(payload, 1)[0]
+        return data
+    if version in LAYOUTS:
+        fields, layout = LAYOUTS[version]
+        try:
+            values = layout.unpack(payload)[1:]
+        except struct.error as error:
+            raise ValueError("RR_Codec : {}".format(error))
+        data = {}
+        for (name, format_char, scale), value in zip(fields, values):
+            data[name] = value / scale if scale != 1 else value
+        data["RR_extpwr"] = bool(data["RR_extpwr"])
+        return data
+    if version == CBOR_V1 and cbor2:
+        numbered = cbor2.loads(payload[1:])
+    elif version == MSGPACK_V1 and msgpack:
+        numbered = msgpack.unpackb(payload[1:], strict_map_key=False)
+    else:
+        raise ValueError("RR_Codec : unknown or unavailable format 0x{:02x}".format(version))
+    all_fields = FIELDS + WINDOW_FIELDS
+    return {all_fields[number][0]: value for number, value in numbered.items() if number < len(all_fields)}
+
+
+def _put_varint(out, value):
+    # Zigzag so small negative changes are small too
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _get_varint(payload, index):
+    value = shift = 0
+    while True:
+        byte = payload[index]
+        index += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            return (value >> 1) ^ -(value & 1), index
+
+
+def encode_samples(samples):
+    """Packs a list of (epoch seconds, volts, mA) readings, at most MAX_SAMPLES, into a Samples payload"""
+    samples = samples[:MAX_SAMPLES]
+    base_time = samples[0][0] if samples else 0.0
+    out = bytearray(SAMPLES_HEADER.pack(SAMPLES_V1, base_time, len(samples)))
+    last_ms = last_mv = last_ma = 0
+    for sample_time, volts, current in samples:
+        ms, mv, ma = int(round((sample_time - base_time) * 1000)), int(round(volts * 1000)), int(round(current))
+        _put_varint(out, ms - last_ms)
+        _put_varint(out, mv - last_mv)
+        _put_varint(out, ma - last_ma)
+        last_ms, last_mv, last_ma = ms, mv, ma
+    return bytes(out)
+
+
+def decode_samples(payload):
+    """Returns the list of (epoch seconds, volts, mA) readings from a Samples payload, raises ValueError if not valid"""
+    if payload[:1] != bytes([SAMPLES_V1]) or len(payload) < SAMPLES_HEADER.size:
+        raise ValueError("RR_Codec : not a samples payload")
+    version, base_time, count = SAMPLES_HEADER.unpack_from(payload)
+    samples = []
+    index = SAMPLES_HEADER.size
+    ms = mv = ma = 0
+    try:
+        for sample in range(count):
+            delta, index = _get_varint(payload, index)
+            ms += delta
+            delta, index = _get_varint(payload, index)
+            mv += delta
+            delta, index = _get_varint(payload, index)
+            ma += delta
+            samples.append((base_time + ms / 1000, mv / 1000, ma))
+    except IndexError:
+        raise ValueError("RR_Codec : samples payload is truncated")
+    return samples
+
+
+def encode_capture(start_time, rate_hz, profile, count, offsets, millivolts, milliamps):
+    """Packs the first count readings of a capture (us since start_time, mV, mA arrays) into a Capture payload"""
+    body = bytearray()
+    last_us = last_mv = last_ma = 0
+    for reading in range(count):
+        _put_varint(body, offsets[reading] - last_us)
+        _put_varint(body, millivolts[reading] - last_mv)
+        _put_varint(body, milliamps[reading] - last_ma)
+        last_us, last_mv, last_ma = offsets[reading], millivolts[reading], milliamps[reading]
+    return CAPTURE_HEADER.pack(CAPTURE_V1, start_time, rate_hz, CAPTURE_PROFILES.index(profile), count) + \
+        zlib.compress(bytes(body), 9)
+
+
+def decode_capture(payload):
+    """Returns dict of Time, Rate_Hz, Profile and Samples, a list of (epoch seconds, volts, mA)
+    Raises ValueError if not a valid Capture payload
+    """
+    if payload[:1] != bytes([CAPTURE_V1]) or len(payload) < CAPTURE_HEADER.size:
+        raise ValueError("RR_Codec : not a capture payload")
+    version, start_time, rate_hz, profile, count = CAPTURE_HEADER.unpack_from(payload)
+    try:
+        body = zlib.decompress(payload[CAPTURE_HEADER.size:])
+    except zlib.error as error:
+        raise ValueError("RR_Codec : {}".format(error))
+    samples = []
+    index = 0
+    us = mv = ma = 0
+    try:
+        for reading in range(count):
+            delta, index = _get_varint(body, index)
+            us += delta
+            delta, index = _get_varint(body, index)
+            mv += delta
+            delta, index = _get_varint(body, index)
+            ma += delta
+            samples.append((start_time + us / 1e6, mv / 1000, ma))
+    except IndexError:
+        raise ValueError("RR_Codec : capture payload is truncated")
+    return {'Time': start_time,
+            'Rate_Hz': rate_hz,
+            'Profile': CAPTURE_PROFILES[profile] if profile < len(CAPTURE_PROFILES) else None,
+            'Samples': samples}
+
+
+# Compare payload sizes for a typical Data message
+if __name__ == "__main__":
+    example = dict(RR_volts=4.12, RR_current=-512, RR_charge=94, RR_extpwr=True, RR_CPUTEMP=47.2,
+                   RR_CPUSTAT=0, RR_WARN=10, RR_VMIN=2.9, RR_INTERVAL=30)
+    for test_encoding in available():
+        encoded = encode(example, test_encoding)
+        print("RR_Codec : {:8} {:4} bytes {}".format(test_encoding, len(encoded), decode(encoded)))
+    example.update(RR_V_MIN=4.05, RR_I_MIN=-530, RR_I_MAX=1890, RR_I_MEAN=-320, RR_I_RMS=640, RR_WH=-0.0123,
+                   RR_T_FULL=0, RR_T_CHARGING=27, RR_T_DISCHARGING=3, RR_WINDOW=30, RR_N=6)
+    for test_encoding in available():
+        encoded = encode(example, test_encoding)
+        print("RR_Codec : {:8} {:4} bytes with window statistics".format(test_encoding, len(encoded)))
+    print("RR_Codec : decoded", decode(encode(example, "struct")))
+    example["RR_TIME"] = 1700000000
+    for test_encoding in available():
+        print("RR_Codec : {:8} RR_TIME {}".format(test_encoding, decode(encode(example, test_encoding))["RR_TIME"]))
+
+    # A 5 minute period at 5s intervals, discharging
+    readings = [(1700000000 + reading * 5.0, 4.1 - reading * 0.0005, 480 + reading % 7 * 10) for reading in range(60)]
+    encoded = encode_samples(readings)
+    decoded = decode_samples(encoded)
+    print("RR_Codec : samples  {:4} bytes for {} readings, max error {:.4f}V".format(
+        len(encoded), len(decoded), max(abs(a[1] - b[1]) for a, b in zip(readings, decoded))))
+
+    # 10 seconds at 200Hz, with a 2A inrush peak
+    import array
+    import random
+    count = 2000
+    offsets = array.array('I', (reading * 5000 + random.randint(0, 60) for reading in range(count)))
+    millivolts = array.array('H', (4100 - (300 if 400 <= reading < 420 else 0) for reading in range(count)))
+    milliamps = array.array('h', ((2000 if 400 <= reading < 420 else 450) + random.randint(-8, 8)
+                                  for reading in range(count)))
+    encoded = encode_capture(1700000000.0, 200, "9bit", count, offsets, millivolts, milliamps)
+    decoded = decode_capture(encoded)
+    print("RR_Codec : capture  {:4} bytes for {} readings ({:.1f} bytes/reading), peak {}mA".format(
+        len(encoded), len(decoded['Samples']), len(encoded) / count, max(sample[2] for sample in decoded['Samples'])))
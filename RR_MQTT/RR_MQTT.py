@@ -21,21 +21,44 @@
 
 # Import libraries
 import paho.mqtt.client as mqtt
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
 
 import socket
 import argparse
+import asyncio
+import collections
+import math
 import yaml
 import signal
-import subprocess
-import threading
 import logging
+import threading
 import os
 import time
+from array import array
 from json import dumps, loads, JSONDecodeError
 
 # This controls the battery monitoring IC
 from ina219 import INA219, DeviceRangeError
 
+# Cached CPU temperature and throttle status
+from RR_SysHealth import health
+
+# Stage timings, sent on the Timings command or logged on SIGUSR1
+from RR_Timing import timings, Ticker, BUCKETS
+
+# Time limited I2C reads with retries, and a watchdog for missing samples
+from RR_Watchdog import BoundedI2C, Watchdog
+
+# Shares the I2C bus with other Red Reactor monitors
+from RR_I2CLock import i2c_lock
+
+# Data topic payload encodings (JSON, struct, CBOR, MessagePack)
+import RR_Codec
+
+# Messages that could not be sent are kept on disk until the broker is back
+from RR_Queue import DiskQueue
+
 parser = argparse.ArgumentParser(description="Red Reactor MQTT client")
 parser.add_argument(
     "-c",
@@ -52,6 +75,14 @@ RR_SERVICE = "RedReactor"
 RR_SERVICE_STATUS = "Service"
 RR_SERVICE_DATA = "Data"
 RR_SERVICE_CMDS = "Command"
+RR_SERVICE_TIMINGS = "Timings"
+RR_SERVICE_SAMPLES = "Samples"
+RR_SERVICE_CAPTURE = "Capture"
+RR_SERVICE_HISTORY = "History"
+RR_SERVICE_HISTORY_RANGE = "HistoryRange"
+RR_SERVICE_STATS = "Stats"
+# Sent as the 'schema' user property with MQTT v5, changed when the topic payloads change incompatibly
+RR_SCHEMA_VERSION = "1"
 
 # RED REACTOR data
 I2C_ADDRESS = 0x40
@@ -66,8 +97,29 @@ BATTERY_WARN = 10
 # Change BATTERY_VMIN if you want to set an earlier or later shutdown
 BATTERY_VMIN = 2.9
 
-# Important to read battery regularly to check status
+# Important to read battery regularly to check status, default for config read_interval
 READ_INTERVAL = 5
+MIN_READ_INTERVAL = 0.1
+
+# Queued messages awaiting PUBACK before sending more, and how often to check for queued messages
+QUEUE_INFLIGHT = 10
+QUEUE_POLL = 0.5
+
+# MQTT client housekeeping (keepalive) interval, and reconnect backoff limits in seconds
+MISC_INTERVAL = 1
+RECONNECT_MIN = 1
+RECONNECT_MAX = 120
+# Longest wait for the broker to acknowledge the offline status when exiting
+OFFLINE_TIMEOUT = 5
+# CONNACK reason code from a broker (or paho for a 3.1.1 broker's refusal) not supporting MQTT v5
+UNSUPPORTED_PROTOCOL_VERSION = 132
+
+# Capture command limits, the buffers are allocated up front for the whole capture
+CAPTURE_MAX_SECONDS = 60
+CAPTURE_MAX_RATE = 1000
+CAPTURE_MAX_SAMPLES = 20000
+# The I2C lock is released between chunks of a capture, so other monitors still get their readings
+CAPTURE_CHUNK = 0.25
 
 
 def load_config(config_file):
@@ -82,8 +134,35 @@ def load_config(config_file):
             "username": None,
             "password": None,
         },
+        # MQTT protocol 3.1.1 or 5, MQTT v5 falls back to 3.1.1 if the broker doesn't support it
+        "mqtt_protocol": "3.1.1",
+        # With MQTT v5, replace repeated topic strings by 2 byte aliases
+        "topic_aliases": True,
+        # Seconds a Data/Samples reading stays useful: expiry sent with MQTT v5, older queued messages dropped
+        "message_expiry": None,
 
         "publish_period": 30,
+        # Publish early when a value has moved this far since the last publish, e.g. {'volts': 0.05, 'current': 100}
+        "deadband": {},
+        # Longest time without a publish (heartbeat), defaults to publish_period
+        "max_silence": None,
+        # Data topic payload: json, struct, cbor or msgpack (see RR_Codec.py)
+        "encoding": "json",
+        # Battery read interval in seconds, and publish every reading of each period on the Samples topic
+        "read_interval": READ_INTERVAL,
+        "samples": False,
+        # Add min/max/mean/RMS current, min voltage, energy and time in each state since the last publish to Data
+        "aggregate": False,
+        # Store and forward: unsent Data/Samples messages are kept in queue_file (None to disable),
+        # up to queue_max_bytes, and sent at up to drain_rate messages a second once reconnected
+        "queue_file": "RR_MQTT.queue",
+        "queue_max_bytes": 1024 * 1024,
+        "drain_rate": 5,
+        # Retained History topic of the last history_points points (0 to disable), one per history_interval seconds
+        "history_points": 120,
+        "history_interval": 60,
+        # Publish latency, MQTT queue depths and connection counts on the Stats topic and in the log (0 to disable)
+        "stats_interval": 300,
         "hostname": HOST_NAME,
         "offline": "OFF",
         "online": "ON"
@@ -92,13 +171,17 @@ def load_config(config_file):
     return {**default_config, **config_override}
 
 
-def mqtt_on_connect(mqtt_client, userdata, flags, rc):
+def mqtt_on_connect(mqtt_client, userdata, flags, rc, properties=None):
     """Set Last Will message, subscribe to command topic and update service status to broker."""
     global client_connected
 
     if rc == 0:
         logger.info("Connected to MQTT broker")
         client_connected = True
+        timings.count('mqtt_connect')
+        mqtt_client.connected(properties)
+        if mqtt_loop is not None:
+            mqtt_loop.connected()
         mqtt_client.will_set(
             f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_STATUS}",
             payload=config['offline'],
@@ -130,16 +213,35 @@ def mqtt_on_connect(mqtt_client, userdata, flags, rc):
         # Subscribe to the command return topic
         logger.info("Subscribing to topic " + f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_CMDS}")
         mqtt_client.subscribe(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_CMDS}")
+
+        # The retained History message from before a restart, to carry on from
+        if history is not None and not history.seeded:
+            mqtt_client.subscribe(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_HISTORY}")
+    elif rc == UNSUPPORTED_PROTOCOL_VERSION and mqtt_client.mqtt_v5:
+        logger.warning("MQTT broker does not support MQTT v5, using 3.1.1")
+        mqtt_client.use_mqttv311()
     else:
         logger.error(f"MQTT broker connection refused, error code = {rc}")
 
 
-def mqtt_on_disconnect(mqtt_client, userdata, rc):
+def mqtt_on_disconnect(mqtt_client, userdata, rc, properties=None):
     """Handle temporary network connection issues"""
     global client_connected
 
     logger.warning(f"Disconnected from MQTT broker: {rc}")
     client_connected = False
+    timings.count('mqtt_disconnect')
+    publish_stats.disconnected()
+
+
+def mqtt_on_publish(mqtt_client, userdata, mid):
+    """Message sent (qos=0) or acknowledged by the broker (qos=1)"""
+    publish_stats.acked(mid)
+    if drain is not None:
+        drain.acked(mid)
+    waiter = publish_waiters.pop(mid, None)
+    if waiter is not None and not waiter.done():
+        waiter.set_result(True)
 
 
 def on_message(clientid, userdata, message):
@@ -149,10 +251,33 @@ def on_message(clientid, userdata, message):
     'Interval': 25
     'WARN': 10
     'VMIN': 3.0
+    'Timings': 1
+    'Capture': {'seconds': 10, 'rate_hz': 200, 'profile': '9bit'}
+    'History': {'since': 3600, 'points': 60}
     """
-    global config, BATTERY_WARN, BATTERY_VMIN
+    global BATTERY_WARN, BATTERY_VMIN
 
-    logger.debug(f"message received {str(message.payload.decode('utf-8'))}")
+    if message.topic.endswith(f"/{RR_SERVICE_HISTORY}"):
+        # Retained history (or our own first publish if there was none), only needed once
+        if message.retain:
+            try:
+                history.load(message.payload)
+                logger.info(f"Loaded {len(history.points)} history points")
+            except (ValueError, TypeError, KeyError) as error:
+                logger.warning(f"Retained history not loaded: {error}")
+        history.seeded = True
+        clientid.unsubscribe(message.topic)
+        return
+
+    if message.topic.endswith(f"/{RR_SERVICE_DATA}"):
+        # Own data (DEBUG subscription), may be binary
+        try:
+            logger.debug(f"data received {RR_Codec.decode(message.payload)}")
+        except ValueError as error:
+            logger.debug(f"data received, unable to decode: {error}")
+        return
+
+    logger.debug(f"message received {str(message.payload.decode('utf-8', 'replace'))}")
     logger.debug(f"message topic={message.topic}")
     logger.debug(f"message qos={message.qos}")
     logger.debug(f"message retain flag={message.retain}")
@@ -160,17 +285,17 @@ def on_message(clientid, userdata, message):
     # Commands expected as JSON format string
     try:
         message_data = loads(str(message.payload.decode("utf-8")))
-    except JSONDecodeError:
-        logger.warning(f"Non-JSON msg received: {str(message.payload.decode('utf-8'))}")
+    except (JSONDecodeError, UnicodeDecodeError):
+        logger.warning(f"Non-JSON msg received: {str(message.payload.decode('utf-8', 'replace'))}")
         return
 
     if "Shutdown" in message_data.keys():
         logger.info("Shutdown command received!")
-        mqtt_on_exit(0, 0, 1)
+        request_exit(1)
 
     if "Reboot" in message_data.keys():
         logger.info("Reboot command received!")
-        mqtt_on_exit(0, 0, 2)
+        request_exit(2)
 
     if "Interval" in message_data.keys():
         try:
@@ -193,83 +318,665 @@ def on_message(clientid, userdata, message):
         except ValueError:
             logger.error("Error changing Shutdown Threshold")
 
+    if "Timings" in message_data.keys():
+        logger.info("Publishing stage timings")
+        clientid.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_TIMINGS}",
+                         dumps(timings.snapshot()))
+
+    if "Capture" in message_data.keys():
+        start_capture(clientid, message_data['Capture'])
+
+    if "History" in message_data.keys():
+        try:
+            if history is None:
+                raise ValueError("history_points is 0")
+            request = message_data['History'] if isinstance(message_data['History'], dict) else {}
+            since = request.get('since')
+            history_range = history.range(None if since is None else float(since),
+                                          max(1, int(request.get('points', 60))))
+            logger.info(f"Publishing {len(history_range['Points'])} history points")
+            clientid.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_HISTORY_RANGE}",
+                             dumps(history_range, separators=(",", ":")), qos=1)
+        except (TypeError, ValueError) as error:
+            logger.error(f"Error in History command: {error}")
+
+
+class PublishTrigger:
+    """Decides when the Data topic is published:
+    a forced event (e.g. power removed), a value moving by more than its deadband since the last publish,
+    or no publish for max_silence seconds (heartbeat)
+    """
 
-def mqtt_on_exit(signum, frame, exit_option=0):
+    def __init__(self):
+        self.forced = None
+        self.last_publish = None
+        self.published = {}
+
+    def force(self, reason):
+        """Publish on the next check, the first reason is kept"""
+        if self.forced is None:
+            self.forced = reason
+
+    def check(self, now, values, deadband, max_silence):
+        """Returns the reason to publish now, or None"""
+        if self.forced is not None:
+            return self.forced
+        if self.last_publish is None:
+            return "startup"
+        if now - self.last_publish >= max_silence:
+            return "heartbeat"
+        for name, band in deadband.items():
+            if name in values and name in self.published and abs(values[name] - self.published[name]) >= band:
+                return name
+        return None
+
+    def done(self, now, values):
+        """Call once the data has been published, values become the deadband reference"""
+        self.last_publish = now
+        self.published = dict(values)
+        self.forced = None
+
+
+class WindowStats:
+    """Current, voltage, energy and state statistics over a publish window
+    Updated as each reading arrives, so memory use doesn't depend on the window length
     """
-    Update MQTT services' status to `offline`
-    Called when local program exit is received.
+
+    STATES = ("FULL", "CHARGING", "DISCHARGING")
+
+    def __init__(self):
+        # Carried across windows, so the first reading of a window covers the time since the last reading
+        self.last_time = None
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.window = 0.0
+        self.i_min = self.i_max = None
+        self.i_sum = self.i_squares = 0.0
+        self.v_min = None
+        self.v_sum = 0.0
+        self.energy = 0.0
+        self.state_time = dict.fromkeys(self.STATES, 0.0)
+
+    def add(self, now, volts, current):
+        """Adds a reading at monotonic time now, current in mA (>10 discharging, <0 charging)"""
+        elapsed = now - self.last_time if self.last_time is not None else 0.0
+        self.last_time = now
+        self.count += 1
+        self.window += elapsed
+        self.i_min = current if self.i_min is None else min(self.i_min, current)
+        self.i_max = current if self.i_max is None else max(self.i_max, current)
+        self.i_sum += current
+        self.i_squares += current * current
+        self.v_min = volts if self.v_min is None else min(self.v_min, volts)
+        self.v_sum += volts
+        # Wh taken from the battery, negative when charging
+        self.energy += volts * current / 1000 * elapsed / 3600
+        state = "DISCHARGING" if current > 10 else "FULL" if current >= 0 else "CHARGING"
+        self.state_time[state] += elapsed
+
+    def fields(self):
+        """Returns the Data topic fields for the window, empty if there were no readings"""
+        if not self.count:
+            return {}
+        return dict(RR_V_MIN=round(self.v_min, 3),
+                    RR_I_MIN=int(round(self.i_min)),
+                    RR_I_MAX=int(round(self.i_max)),
+                    RR_I_MEAN=int(round(self.i_sum / self.count)),
+                    RR_I_RMS=int(round((self.i_squares / self.count) ** 0.5)),
+                    RR_WH=round(self.energy, 4),
+                    RR_T_FULL=int(round(self.state_time["FULL"])),
+                    RR_T_CHARGING=int(round(self.state_time["CHARGING"])),
+                    RR_T_DISCHARGING=int(round(self.state_time["DISCHARGING"])),
+                    RR_WINDOW=int(round(self.window)),
+                    RR_N=self.count)
+
+
+class History:
+    """Rolling history of one point per interval (mean/min volts, mean/max mA) for the retained History topic
+    Each point is encoded once as it is added, so republishing only joins the stored points
+    """
+
+    FIELDS = ["Time", "RR_volts", "RR_V_MIN", "RR_current", "RR_I_MAX"]
+
+    def __init__(self, points, interval):
+        self.interval = interval
+        self.points = collections.deque(maxlen=points)
+        self.encoded = collections.deque(maxlen=points)
+        self.window = WindowStats()
+        self.window_start = None
+        # Set once the retained message from before a restart has been loaded (or there was none)
+        self.seeded = False
+
+    def add(self, now, volts, current):
+        """Adds a reading at monotonic time now, returns True when it completes a new point"""
+        if self.window_start is None:
+            self.window_start = now
+        self.window.add(now, volts, current)
+        if now - self.window_start < self.interval:
+            return False
+        window = self.window
+        self._append([int(time.time()), round(window.v_sum / window.count, 3), round(window.v_min, 3),
+                      int(round(window.i_sum / window.count)), int(round(window.i_max))])
+        window.reset()
+        self.window_start = now
+        return True
+
+    def _append(self, point):
+        self.points.append(point)
+        self.encoded.append(dumps(point, separators=(",", ":")))
+
+    def payload(self):
+        """The History topic payload, {"Interval": s, "Fields": [...], "Points": [[Time, ...], ...]}"""
+        return '{{"Interval":{},"Fields":{},"Points":[{}]}}'.format(
+            self.interval, dumps(self.FIELDS, separators=(",", ":")), ",".join(self.encoded))
+
+    def load(self, payload):
+        """Continues from a History payload, e.g. the retained one after a restart, unless points were added"""
+        data = loads(payload)
+        if data['Fields'] != self.FIELDS:
+            raise ValueError("different fields")
+        if not self.points:
+            for point in data['Points'][-self.points.maxlen:]:
+                self._append(point)
+
+    def range(self, since, max_points):
+        """Points from the last since seconds (None for all), averaged in groups of consecutive points to at most
+        max_points
+        """
+        start = 0 if since is None else time.time() - since
+        selected = [point for point in self.points if point[0] >= start]
+        group = max(1, math.ceil(len(selected) / max_points))
+        points = []
+        for first in range(0, len(selected), group):
+            chunk = selected[first:first + group]
+            points.append([chunk[0][0],
+                           round(sum(point[1] for point in chunk) / len(chunk), 3),
+                           min(point[2] for point in chunk),
+                           int(round(sum(point[3] for point in chunk) / len(chunk))),
+                           max(point[4] for point in chunk)])
+        return dict(Interval=self.interval * group, Fields=self.FIELDS, Points=points)
+
+
+class PublishStats:
+    """Publish latency and MQTT client queue depths, for the Stats topic
+    Latencies go to the shared timings: publish_puback (publish to PUBACK, qos=1), publish_written (publish to
+    socket write, qos=0), sample_publish (battery read to Data publish) and queued_age (reading time to drained)
+    """
+
+    def __init__(self):
+        # Message id -> (perf_counter at publish, qos)
+        self.sent = {}
+        self.depths_max = {}
+
+    def published(self, message, qos):
+        if message.rc == mqtt.MQTT_ERR_SUCCESS:
+            self.sent[message.mid] = (time.perf_counter(), qos)
+
+    def acked(self, mid):
+        sent = self.sent.pop(mid, None)
+        if sent is not None:
+            timings.observe('publish_puback' if sent[1] else 'publish_written', time.perf_counter() - sent[0])
+
+    def disconnected(self):
+        # Unsent qos=0 messages are dropped by paho, qos=1 ones are sent again after reconnecting
+        self.sent = {mid: sent for mid, sent in self.sent.items() if sent[1]}
+
+    def depths(self, mqtt_client):
+        """Current queue lengths, paho has no public API for its own so they may read 0 on other versions"""
+        depths = dict(paho_out_messages=len(getattr(mqtt_client, '_out_messages', ())),
+                      paho_out_packets=len(getattr(mqtt_client, '_out_packet', ())),
+                      awaiting_ack=len(self.sent),
+                      offline_queue=len(offline_queue) if offline_queue is not None else 0)
+        for name, depth in depths.items():
+            self.depths_max[name] = max(depth, self.depths_max.get(name, 0))
+        return depths
+
+    def snapshot(self, mqtt_client):
+        """Returns the shared timings with the current and peak (since the last snapshot) queue depths"""
+        depths = self.depths(mqtt_client)
+        snapshot = dict(timings.snapshot(), queues=depths, queues_max=self.depths_max, bucket_bounds=BUCKETS)
+        self.depths_max = dict(depths)
+        return snapshot
+
+
+class RRClient(mqtt.Client):
+    """paho client that notes the time of each publish, for the publish to PUBACK latency
+    With MQTT v5 each publish carries the schema user property, and optionally a message expiry and a topic alias
+    """
+
+    def __init__(self, client_id, protocol, topic_aliases=True):
+        self.mqtt_v5 = protocol == mqtt.MQTTv5
+        self.topic_aliases = topic_aliases
+        # Topic -> alias on this connection, up to the broker's Topic Alias Maximum
+        self.aliases = {}
+        self.alias_max = 0
+        # clean_session is MQTT 3.1.1 only, v5 uses clean_start on connect
+        super().__init__(client_id=client_id, clean_session=None if self.mqtt_v5 else True, userdata=None,
+                         protocol=protocol, transport="tcp")
+
+    def connected(self, properties):
+        # Aliases only last for one connection
+        self.aliases = {}
+        self.alias_max = getattr(properties, 'TopicAliasMaximum', 0) if self.topic_aliases else 0
+        if self.alias_max:
+            logger.info(f"Using up to {self.alias_max} MQTT topic aliases")
+
+    def use_mqttv311(self):
+        """Falls back to MQTT 3.1.1 from the next connect, as paho itself does from 3.1.1 to 3.1"""
+        self.mqtt_v5 = False
+        self._protocol = mqtt.MQTTv311
+        self._clean_session = True
+
+    def publish(self, topic, payload=None, qos=0, retain=False, properties=None, expiry=None):
+        """As paho publish, expiry is the message expiry in seconds (MQTT v5 only)"""
+        if self.mqtt_v5 and properties is None:
+            properties = Properties(PacketTypes.PUBLISH)
+            properties.UserProperty = ("schema", RR_SCHEMA_VERSION)
+            if expiry is not None:
+                properties.MessageExpiryInterval = max(1, int(expiry))
+            # Only qos=0, as paho sends unacknowledged qos=1 messages again as they were after reconnecting,
+            # when their alias no longer exists
+            if qos == 0 and self.alias_max:
+                alias = self.aliases.get(topic)
+                if alias is not None:
+                    properties.TopicAlias = alias
+                    topic = ""
+                elif len(self.aliases) < self.alias_max:
+                    properties.TopicAlias = self.aliases[topic] = len(self.aliases) + 1
+        message = super().publish(topic, payload, qos, retain, properties)
+        publish_stats.published(message, qos)
+        return message
+
+
+async def report_stats(mqtt_client):
+    """Samples the queue depths every MISC_INTERVAL, and every config[stats_interval] seconds logs a summary and
+    publishes the statistics as json on the Stats topic
+    """
+    next_report = time.monotonic() + config['stats_interval']
+    while True:
+        await asyncio.sleep(MISC_INTERVAL)
+        publish_stats.depths(mqtt_client)
+        if time.monotonic() < next_report:
+            continue
+        next_report += config['stats_interval']
+        snapshot = publish_stats.snapshot(mqtt_client)
+        latency = ", ".join("{} p50 {:.1f}ms p95 {:.1f}ms max {:.1f}ms".format(
+            name, stage['p50'] * 1000, stage['p95'] * 1000, stage['max'] * 1000)
+            for name, stage in sorted(snapshot['stages'].items())
+            if name in ('sample_publish', 'publish_puback', 'publish_written', 'queued_age'))
+        logger.info(f"Stats: {latency or 'no publishes'}; peak queues {snapshot['queues_max']}; "
+                    f"connects {snapshot['counters'].get('mqtt_connect', 0)}, "
+                    f"disconnects {snapshot['counters'].get('mqtt_disconnect', 0)}, "
+                    f"connect errors {snapshot['counters'].get('reconnect_error', 0)}")
+        if client_connected:
+            mqtt_client.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_STATS}",
+                                dumps(snapshot, separators=(",", ":")))
+
+
+def publish_or_queue(mqtt_client, topic, payload, queued_payload=None):
+    """Publishes if connected, else (or if the publish fails) adds queued_payload (default payload)
+    to the offline queue
     """
-    global stop_thread
+    if client_connected and mqtt_client.publish(topic, payload,
+                                                expiry=config['message_expiry']).rc == mqtt.MQTT_ERR_SUCCESS:
+        return
+    if offline_queue is None:
+        timings.count('publish_skipped')
+        return
+    offline_queue.put(topic, payload if queued_payload is None else queued_payload)
+
+
+class QueueDrain:
+    """Sends the offline queue once reconnected, oldest first with qos=1
+    Limited to config[drain_rate] messages a second and QUEUE_INFLIGHT awaiting PUBACK, so live data keeps flowing
+    Messages older than config[message_expiry] are dropped, the rest sent with what is left of it
+    """
+
+    def __init__(self, offline_queue):
+        self.queue = offline_queue
+        # Message id -> queue token of messages awaiting PUBACK
+        self.inflight = {}
+
+    def acked(self, mid):
+        token = self.inflight.pop(mid, None)
+        if token is not None:
+            self.queue.ack(token)
+
+    async def run(self, mqtt_client):
+        while True:
+            if client_connected and len(self.inflight) < QUEUE_INFLIGHT:
+                record = self.queue.next()
+                if record is not None:
+                    token, topic, payload, timestamp = record
+                    age = time.time() - timestamp
+                    expiry = config['message_expiry']
+                    if expiry is not None and age >= expiry:
+                        timings.count('queue_expired')
+                        self.queue.ack(token)
+                        continue
+                    message = mqtt_client.publish(topic, payload, qos=1,
+                                                  expiry=None if expiry is None else expiry - age)
+                    # Not connected: paho keeps qos=1 messages and sends them once reconnected
+                    if message.rc in (mqtt.MQTT_ERR_SUCCESS, mqtt.MQTT_ERR_NO_CONN):
+                        self.inflight[message.mid] = token
+                        timings.observe('queued_age', age)
+                    else:
+                        # Not kept by paho, so send again from the oldest unacknowledged record, once those
+                        # paho is sending (again after a reconnect, with the same message id) are acknowledged
+                        while self.inflight:
+                            await asyncio.sleep(QUEUE_POLL)
+                        self.queue.rewind()
+                    await asyncio.sleep(1 / max(config['drain_rate'], 0.1))
+                    continue
+            await asyncio.sleep(QUEUE_POLL)
+
+
+class AsyncioMQTT:
+    """Runs the paho client on the asyncio event loop in place of loop_forever
+    The socket is watched with add_reader/add_writer, keepalive is sent by a housekeeping task
+    """
+
+    def __init__(self, loop, mqtt_client):
+        self.loop = loop
+        self.client = mqtt_client
+        self.misc = None
+        # Wait before the next connect attempt, reset by connected() once the broker accepts a connection
+        self.delay = RECONNECT_MIN
+        # Called on the event loop, except during reconnect() which runs in an executor thread
+        mqtt_client.on_socket_open = lambda client, userdata, sock: self.call(self.opened, sock)
+        mqtt_client.on_socket_close = lambda client, userdata, sock: self.call(self.loop.remove_reader, sock)
+        mqtt_client.on_socket_register_write = \
+            lambda client, userdata, sock: self.call(self.loop.add_writer, sock, self.write)
+        mqtt_client.on_socket_unregister_write = \
+            lambda client, userdata, sock: self.call(self.loop.remove_writer, sock)
+
+    def call(self, function, *args):
+        if threading.current_thread() is threading.main_thread():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def opened(self, sock):
+        self.loop.add_reader(sock, self.read)
+        if self.misc is None or self.misc.done():
+            self.misc = self.loop.create_task(self.housekeeping())
+
+    def read(self):
+        self.client.loop_read()
 
-    logger.info("Exiting ...")
-    stop_thread = True
+    def write(self):
+        self.client.loop_write()
 
-    logger.info("Sending offline message")
-    client.publish(
+    async def housekeeping(self):
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(MISC_INTERVAL)
+
+    async def keep_connected(self):
+        """Connects, and reconnects with doubling backoff whenever the connection is lost
+        A broker that accepts the TCP connection but refuses the CONNECT is backed off from as well
+        """
+        while True:
+            if self.client.socket() is None:
+                try:
+                    # Blocking TCP connect, kept off the event loop
+                    await self.loop.run_in_executor(None, self.client.reconnect)
+                except (OSError, socket.timeout) as error:
+                    logger.error(f"** Unable to connect to the MQTT Broker {error}")
+                    timings.count('reconnect_error')
+                # Doubled before waiting, so a CONNACK arriving meanwhile leaves it reset
+                delay = self.delay
+                self.delay = min(delay * 2, RECONNECT_MAX)
+                await asyncio.sleep(delay)
+                continue
+            await asyncio.sleep(RECONNECT_MIN)
+
+    def connected(self):
+        """Called by on_connect when the broker accepts the connection"""
+        self.delay = RECONNECT_MIN
+
+    async def publish_wait(self, topic, payload, timeout, **kwargs):
+        """Publishes with qos=1 and waits up to timeout for the broker's acknowledgement
+        Returns True if acknowledged
+        """
+        message = self.client.publish(topic, payload, qos=1, **kwargs)
+        if message.rc != mqtt.MQTT_ERR_SUCCESS:
+            return False
+        waiter = publish_waiters[message.mid] = self.loop.create_future()
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+
+
+def connect_ina():
+    """Returns the configured INA219, also used to re-open the bus after read failures"""
+    ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, busnum=1, log_level=logging.ERROR)
+    ina.configure(ina.RANGE_16V)
+    return ina
+
+
+def read_stalled(seconds):
+    """Called by the watchdog thread when no good battery reading has arrived for a while"""
+    logger.critical(f"No Red Reactor reading for {seconds:.0f}s")
+    # Publish from the event loop, which owns the client
+    event_loop.call_soon_threadsafe(lambda: client.publish(
         f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_STATUS}",
-        payload=config["offline"],
+        payload="RR_Read_Error",
         qos=1,
         retain=True,
-    )
-    # Short delay ensures msg sent
-    time.sleep(5)
-    # Check if need to apply client.disconnect
+    ))
 
-    battery_thread.join()
-    if exit_option == 0:
-        exit(0)
-    elif exit_option == 1:
-        # execute shutdown
-        os.system("sudo shutdown now")
-        # exit(3)
+
+def request_exit(exit_option=0):
+    """
+    Stop the monitoring tasks and exit, 0 = exit, 1 = shutdown, 2 = reboot
+    Called on SIGINT/SIGTERM and by the Shutdown/Reboot commands, the first request wins
+    """
+    global exit_request
+
+    if exit_request is None:
+        logger.info("Exiting ...")
+        exit_request = exit_option
+        stop_event.set()
+
+
+async def go_offline(mqtt, tasks):
+    """
+    Update MQTT services' status to `offline`
+    Cancels the monitoring tasks and any capture, then waits (briefly) for the broker to acknowledge the status
+    """
+    capture_stop.set()
+    if capture_task is not None:
+        tasks = tasks + [capture_task]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    if client_connected:
+        logger.info("Sending offline message")
+        if not await mqtt.publish_wait(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_STATUS}",
+                                       config["offline"], OFFLINE_TIMEOUT, retain=True):
+            logger.warning("Offline message not acknowledged")
+        client.disconnect()
+    if offline_queue is not None:
+        offline_queue.close()
+
+
+def read_battery(ina):
+    """Returns (volts, mA), mA is None if the current is out of range
+    Run in an executor thread as the I2C read may block
+    """
+    # One locked transaction, waking the device in case another monitor left it asleep
+    with i2c_lock, timings.stage('i2c_read'):
+        ina.wake()
+        # Voltage first, so it is still valid for the shutdown check when the current is out of range
+        volts = ina.voltage()
+        try:
+            # <0 is charging, <10 is FULL, >10 is discharging
+            return volts, ina.current()
+        except DeviceRangeError:
+            return volts, None
+
+
+def run_capture(ina, seconds, rate_hz, profile):
+    """Reads volts/current rate_hz times a second with the profile's ADC resolution, run in an executor thread
+    Returns (start epoch, count, us since start, mV, mA), normal 12 bit conversions are restored afterwards
+    """
+    count = min(int(seconds * rate_hz), CAPTURE_MAX_SAMPLES)
+    offsets = array('I', bytes(4 * count))
+    millivolts = array('H', bytes(2 * count))
+    milliamps = array('h', bytes(2 * count))
+    adc = getattr(ina, "ADC_" + profile.upper())
+    period = 1 / rate_hz
+    recorded = 0
+    try:
+        with i2c_lock:
+            ina.configure(ina.RANGE_16V, bus_adc=adc, shunt_adc=adc)
+        start_time = time.time()
+        start = chunk_end = time.perf_counter()
+        while recorded < count and not capture_stop.is_set():
+            chunk_end += CAPTURE_CHUNK
+            with i2c_lock:
+                ina.wake()
+                while recorded < count:
+                    # Readings are timed from the start, so a slow read doesn't delay the rest
+                    due = start + recorded * period
+                    if due >= chunk_end:
+                        break
+                    now = time.perf_counter()
+                    if due > now:
+                        time.sleep(due - now)
+                        now = time.perf_counter()
+                    try:
+                        volts, current = ina.voltage(), ina.current()
+                    except DeviceRangeError:
+                        timings.count('capture_range_error')
+                        volts, current = ina.voltage(), MAX_EXPECTED_AMPS * 1000
+                    offsets[recorded] = int((now - start) * 1e6)
+                    millivolts[recorded] = round(volts * 1000)
+                    milliamps[recorded] = max(-0x8000, min(0x7FFF, round(current)))
+                    recorded += 1
+    finally:
+        with i2c_lock:
+            try:
+                ina.configure(ina.RANGE_16V)
+            except OSError:
+                # Re-opens the bus with the normal configuration
+                ina.reset()
+    return start_time, recorded, offsets, millivolts, milliamps
+
+
+async def capture(mqtt_client, seconds, rate_hz, profile):
+    """Runs a capture and publishes it as one RR_Codec capture payload on the Capture topic"""
+    logger.info(f"Capturing {seconds}s at {rate_hz}Hz ({profile})")
+    try:
+        with timings.stage('capture'):
+            start_time, recorded, offsets, millivolts, milliamps = await event_loop.run_in_executor(
+                None, run_capture, rr_ina, seconds, rate_hz, profile)
+    except OSError as error:
+        logger.error(f"Capture failed: {error}")
+        return
+    payload = RR_Codec.encode_capture(start_time, rate_hz, profile, recorded, offsets, millivolts, milliamps)
+    logger.info(f"Publishing capture of {recorded} readings, {len(payload)} bytes")
+    if client_connected:
+        mqtt_client.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_CAPTURE}", payload, qos=1)
     else:
-        # execute reboot
-        os.system("sudo reboot now")
-        # exit(4)
+        logger.warning("Capture not sent, MQTT client not connected")
+
+
+def start_capture(mqtt_client, request):
+    """Validates the Capture command and starts it as a task, one capture at a time"""
+    global capture_task
+
+    if rr_ina is None:
+        logger.error("Capture not possible, no Red Reactor connected")
+        return
+    if capture_task is not None and not capture_task.done():
+        logger.warning("Capture already running")
+        return
+    try:
+        seconds = float(request.get('seconds', 10))
+        rate_hz = int(request.get('rate_hz', 200))
+        profile = str(request.get('profile', "9bit"))
+        if not 0 < seconds <= CAPTURE_MAX_SECONDS or not 0 < rate_hz <= CAPTURE_MAX_RATE:
+            raise ValueError(f"seconds up to {CAPTURE_MAX_SECONDS}, rate_hz up to {CAPTURE_MAX_RATE}")
+        if profile not in RR_Codec.CAPTURE_PROFILES:
+            raise ValueError(f"profile one of {', '.join(RR_Codec.CAPTURE_PROFILES)}")
+    except (AttributeError, TypeError, ValueError) as error:
+        logger.error(f"Error in Capture command: {error}")
+        return
+    capture_task = event_loop.create_task(capture(mqtt_client, seconds, rate_hz, profile))
+
+
+async def next_tick(ticker):
+    """Sleeps until the ticker's next deadline without blocking the event loop, as Ticker.wait()"""
+    ticker.deadline += ticker.period
+    await asyncio.sleep(max(0.0, ticker.deadline - time.monotonic()))
+    ticker.tick(advance=False)
 
 
-def publish_battery_status(ina, mqtt_client, stop):
-    """Manages shutdown trigger and publish MQTT messages every config[publish_period]
-    Run as separate timer thread to monitor battery state
-    On_exit will assert stop, terminating thread loop
+async def monitor_battery(ina, mqtt_client):
+    """Manages shutdown trigger and publishes MQTT messages when a value leaves its config[deadband],
+    on state changes, or at least every config[max_silence] (default publish_period)
+    Runs as a task on the event loop until cancelled, or requests a shutdown when the battery is empty
     """
 
     shutdown = False
     volts = BATTERY_ERR
     current = 0
     external_power = True
-    last_publish = time.perf_counter()
-
-    while not shutdown and not stop():
-        if ina:
-            volts = ina.voltage()
-        charge_level = int(max(min(100, (volts - BATTERY_VMIN) / (BATTERY_VMAX - BATTERY_VMIN) * 100), 0))
-
+    # Battery is read every read_interval, against fixed deadlines so slow publishes don't stretch the period
+    ticker = Ticker(config['read_interval'], 'sample')
+    trigger = PublishTrigger()
+    # Readings since the last publish, for the Samples topic and aggregation
+    samples = []
+    window = WindowStats()
+
+    while not shutdown:
         if ina:
             try:
-                # <0 is charging, <10 is FULL, >10 is discharging
-                current = ina.current()
-            except DeviceRangeError:
+                volts, current = await event_loop.run_in_executor(None, read_battery, ina)
+            except OSError as error:
+                # Still failing after retries, the watchdog reports if this persists
+                logger.error(f"Red Reactor I2C read error: {error}")
+                await next_tick(ticker)
+                continue
+            if current is None:
                 # Current out of device range with specified shunt resistor
                 # Assume no ext power so it will still shutdown on low voltage reading
                 logger.error("Red Reactor Battery Current Range Error")
+                timings.count('range_error')
                 external_power = False
                 current = 6000
-                last_publish = 0
+                trigger.force("range_error")
+                if config['aggregate']:
+                    window.add(time.monotonic(), volts, current)
                 mqtt_client.publish(
                     f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_STATUS}",
                     payload="RR_Range_Error",
                     qos=1,
                     retain=True,
                 )
-
             else:
+                if config['aggregate']:
+                    window.add(time.monotonic(), volts, current)
+                if history is not None and history.add(time.monotonic(), volts, current) and client_connected:
+                    # Whole history each time, so a new subscriber gets it in one message
+                    with timings.stage('publish_history'):
+                        mqtt_client.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_HISTORY}",
+                                            history.payload(), qos=1, retain=True)
+                if config['samples']:
+                    samples.append((time.time(), volts, current))
+                    if len(samples) >= RR_Codec.MAX_SAMPLES:
+                        trigger.force("samples_full")
                 # Identify status change
                 if current > 10:
                     # No External Power
                     if external_power:
                         # Power removed, publish immediately
-                        last_publish -= config['publish_period']
+                        trigger.force("power_removed")
                     external_power = False
                 elif current >= 0:
                     # Battery now Full
@@ -278,12 +985,17 @@ def publish_battery_status(ina, mqtt_client, stop):
                     # Charging
                     if not external_power:
                         # Power restored, publish immediately
-                        last_publish -= config['publish_period']
+                        trigger.force("power_restored")
                     external_power = True
+        read_time = time.monotonic()
+        charge_level = int(max(min(100, (volts - BATTERY_VMIN) / (BATTERY_VMAX - BATTERY_VMIN) * 100), 0))
+
+        # Good sample (or no Red Reactor to read)
+        watchdog.kick()
 
         if charge_level <= BATTERY_WARN and not external_power:
             # Force immediate publish update at warning level
-            last_publish -= config['publish_period']
+            trigger.force("battery_warn")
 
         if charge_level == 0 and not external_power:
             shutdown = True
@@ -291,41 +1003,36 @@ def publish_battery_status(ina, mqtt_client, stop):
         if volts > BATTERY_ERR:
             external_power = True
             # Force immediate publish update on battery error
-            last_publish -= config['publish_period']
+            trigger.force("battery_error")
 
         # Shutdown system
         if shutdown:
             # Go Offline and shutdown due to battery empty
             logger.info("Forcing system shutdown, going offline at {:.2f}volts".format(volts))
-            mqtt_client.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_STATUS}",
-                                payload=config["offline"],
-                                qos=1,
-                                retain=True,
-                                )
-            time.sleep(5)
-            # Shutdown system
-            os.system("sudo shutdown now")
-            # exit(0)
+            request_exit(1)
         else:
-            # Publish status at required intervals and sleep till next battery check
-            # State changes are published immediately
+            # Publish on state changes, values leaving their deadband or the heartbeat, then sleep till next check
             logger.debug("Battery Data: {:.2f}v, {:.2f}mA, {}%, ExtPwr:{}".format(volts, current,
                                                                                   charge_level, external_power))
-            if time.perf_counter() - last_publish >= config['publish_period']:
-                last_publish = time.perf_counter()
-                # Add data from vcgencmd into status report
-                try:
-                    cpu_data = subprocess.Popen(['vcgencmd', 'get_throttled'], stdout=subprocess.PIPE)
-                    cpu_data = cpu_data.communicate()
-                    cpu_status = int(cpu_data[0].decode().split("=")[1], 16)
-                    cpu_data = subprocess.Popen(['vcgencmd', 'measure_temp'], stdout=subprocess.PIPE)
-                    cpu_data = cpu_data.communicate()
-                    cpu_temp = float(cpu_data[0].decode().split("=")[1].replace("'C", ""))
-                except (OSError, IndexError, ValueError):
+            # CPU temperature and throttle status (cached), also checked against its deadband
+            with timings.stage('sys_health'):
+                cpu_temp, cpu_status = health.read()
+            values = dict(volts=volts, current=current, charge=charge_level)
+            if cpu_temp is not None:
+                values['cpu_temp'] = cpu_temp
+            # Scheduled tick times are used, so tick lateness doesn't delay the heartbeat by a whole tick
+            reason = trigger.check(ticker.deadline, values, config['deadband'] or {},
+                                   config['max_silence'] or config['publish_period'])
+            if reason is not None:
+                trigger.done(ticker.deadline, values)
+                timings.count('trigger_' + reason)
+                if cpu_temp is None or cpu_status is None:
                     # Failed to extract info
                     logger.error("Failed to read CPU info")
+                if cpu_status is None:
                     # Set top bit (19:0 = normal data)
                     cpu_status = 2**20
+                if cpu_temp is None:
                     cpu_temp = 0
 
                 rr_battery_status = dict(RR_volts=float("{:.2f}".format(volts)),
@@ -338,16 +1045,69 @@ def publish_battery_status(ina, mqtt_client, stop):
                                          RR_VMIN=BATTERY_VMIN,
                                          RR_INTERVAL=config['publish_period']
                                          )
-                if client_connected:
-                    logger.info("Publishing new data")
-                    mqtt_client.publish(f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_DATA}",
-                                        dumps(rr_battery_status))
+                if config['aggregate']:
+                    # Peaks between publishes, over the window since the last publish
+                    rr_battery_status.update(window.fields())
+                    window.reset()
+                logger.info(f"Publishing new data ({reason})")
+                with timings.stage('publish'):
+                    # If queued, the reading time is added as it may be sent much later
+                    publish_or_queue(mqtt_client, f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_DATA}",
+                                     RR_Codec.encode(rr_battery_status, config['encoding']),
+                                     RR_Codec.encode(dict(rr_battery_status, RR_TIME=int(time.time())),
+                                                     config['encoding']))
+                timings.observe('sample_publish', time.monotonic() - read_time)
+
+                # All readings since the last publish as one packed message
+                if samples:
+                    with timings.stage('publish_samples'):
+                        publish_or_queue(mqtt_client, f"{config['hostname']}/{RR_SERVICE}/{RR_SERVICE_SAMPLES}",
+                                         RR_Codec.encode_samples(samples))
+                    samples = []
 
             # Wait for next status check, typically 5s
-            time.sleep(READ_INTERVAL)
+            await next_tick(ticker)
     logger.debug("Exiting monitoring loop")
 
 
+async def main():
+    """Runs the MQTT client, battery monitor and offline queue as tasks on one event loop
+    Returns the exit option once an exit has been requested and the offline status sent
+    """
+    global event_loop, stop_event, drain, mqtt_loop
+
+    event_loop = asyncio.get_running_loop()
+    stop_event = asyncio.Event()
+    mqtt_loop = AsyncioMQTT(event_loop, client)
+
+    # Keep Alive default to 60s, decide if you need it shorter
+    # An on_connect callback will set client_connected
+    client.connect_async(config['mqtt']['broker'], config['mqtt']['port'], 60)
+
+    # Publish exit if locally terminated
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        event_loop.add_signal_handler(signum, request_exit, 0)
+
+    tasks = [event_loop.create_task(mqtt_loop.keep_connected()),
+             event_loop.create_task(monitor_battery(rr_ina, client))]
+    if offline_queue is not None:
+        drain = QueueDrain(offline_queue)
+        tasks.append(event_loop.create_task(drain.run(client)))
+    if config['stats_interval']:
+        tasks.append(event_loop.create_task(report_stats(client)))
+
+    # Run until battery shutdown or user exit, or a task fails
+    stopping = event_loop.create_task(stop_event.wait())
+    done, pending = await asyncio.wait(tasks + [stopping], return_when=asyncio.FIRST_COMPLETED)
+    for task in done:
+        if task is not stopping and not task.cancelled() and task.exception() is not None:
+            logger.critical("Monitoring task failed", exc_info=task.exception())
+            request_exit(3)
+    stopping.cancel()
+    await go_offline(mqtt_loop, tasks)
+    return exit_request
+
+
 # Entry Point for MAIN program execution
 if __name__ == "__main__":
     """Red Reactor MQTT Client startup"""
@@ -387,42 +1147,81 @@ if __name__ == "__main__":
             f_handler.setLevel(config['f_log_level'])
             logger.info(f"File log level set to {config['f_log_level']}")
 
+    if config['encoding'] not in RR_Codec.available():
+        logger.error(f"Data encoding {config['encoding']} not available, using json")
+        config['encoding'] = "json"
+    elif config['encoding'] != "json":
+        logger.info(f"Data encoding set to {config['encoding']}")
+    config['read_interval'] = max(MIN_READ_INTERVAL, float(config['read_interval']))
+    if config['samples']:
+        logger.info(f"Publishing every reading ({config['read_interval']}s) on the {RR_SERVICE_SAMPLES} topic")
+
     # Verify that the RED REACTOR is attached
     rr_ina = None
     try:
-        rr_ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, busnum=1, log_level=logging.ERROR)
-        rr_ina.configure(rr_ina.RANGE_16V)
+        rr_ina = BoundedI2C(connect_ina)
     except (OSError, ModuleNotFoundError) as error:
         # Log error but continue client (on_connect will send error status)
         logger.error(f"** Unable to connect to the Red Reactor {error}")
 
     logger.info("RR MQTT Client setup")
-    client = mqtt.Client(client_id=HOST_NAME,
-                         clean_session=True, userdata=None, protocol=mqtt.MQTTv311, transport="tcp")
+    publish_stats = PublishStats()
+    if str(config['mqtt_protocol']) == "5":
+        logger.info("Using MQTT v5")
+        client = RRClient(HOST_NAME, mqtt.MQTTv5, config['topic_aliases'])
+    else:
+        client = RRClient(HOST_NAME, mqtt.MQTTv311)
     client.on_connect = mqtt_on_connect
     client.on_disconnect = mqtt_on_disconnect
     client.on_message = on_message
+    client.on_publish = mqtt_on_publish
     client_connected = False
     client.username_pw_set(config['mqtt']['username'], config['mqtt']['password'])
 
-    try:
-        # Keep Alive default to 60s, decide if you need it shorter
-        # An on_connect callback will set client_connected
-        client.connect(config['mqtt']['broker'], config['mqtt']['port'], 60)
-    except (ConnectionRefusedError, socket.timeout) as error:
-        # Log error but client loop will continue to try to connect
-        logger.error(f"** Unable to connect to the MQTT Broker {error}")
-
-    # Run battery monitor in separate thread, which also publishes MQTT status updates
-    stop_thread = False
-    battery_thread = threading.Thread(target=publish_battery_status,
-                                      name="RedReactor",
-                                      args=(rr_ina, client, lambda: stop_thread))
-    battery_thread.start()
+    # Publishes an error (and stops systemd watchdog pings) if battery readings stop
+    watchdog = Watchdog(max(config['read_interval'], READ_INTERVAL), escalate=read_stalled)
+    watchdog.start()
 
-    # Publish exit if locally terminated
-    signal.signal(signal.SIGINT, mqtt_on_exit)
-    signal.signal(signal.SIGTERM, mqtt_on_exit)
-
-    # Run forever until battery shutdown or user exit
-    client.loop_forever()
+    # Keep messages that can't be sent, to send once the broker is reachable (also from before a restart)
+    offline_queue = None
+    if config['queue_file']:
+        try:
+            offline_queue = DiskQueue(config['queue_file'], int(config['queue_max_bytes']))
+            if len(offline_queue):
+                logger.info(f"{len(offline_queue)} messages queued from before the restart")
+        except OSError as error:
+            logger.error(f"Unable to open offline queue {config['queue_file']}: {error}")
+
+    # Rolling history for the retained History topic and History command
+    history = None
+    if int(config['history_points']) > 0:
+        history = History(int(config['history_points']), max(1, int(config['history_interval'])))
+
+    # Set up by main(), used by the callbacks, all of which run on the event loop
+    event_loop = None
+    stop_event = None
+    mqtt_loop = None
+    drain = None
+    exit_request = None
+    # Capture command task, and stops its reads when exiting
+    capture_task = None
+    capture_stop = threading.Event()
+    # Message id -> future, for publishes awaiting PUBACK
+    publish_waiters = {}
+
+    # kill -USR1 <pid> logs the stage timings
+    timings.dump_on_signal(logger.info)
+
+    # Run until battery shutdown or user exit
+    exit_option = asyncio.run(main())
+    if exit_option == 0:
+        exit(0)
+    elif exit_option == 1:
+        # execute shutdown
+        os.system("sudo shutdown now")
+    elif exit_option == 2:
+        # execute reboot
+        os.system("sudo reboot now")
+    else:
+        # Restarted by systemd
+        exit(1)
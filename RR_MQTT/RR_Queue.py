@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Bounded store-and-forward queue on disk, for MQTT messages that could not be sent
+
+# queue.put(topic, payload) appends a record to one append-only segment file
+# queue.next() returns the oldest unsent record (token, topic, payload, timestamp) and queue.ack(token) once delivered
+# queue.rewind() after a disconnect sends everything not yet acknowledged again (at least once delivery)
+# Delivered records are skipped by a head offset kept in <file>.head, the file is compacted (rewritten without
+# them) once they take up half of it, and emptied once everything has been delivered
+# When the file would exceed max_bytes the oldest records are dropped, even if they are being sent, and the file
+# compacted, dropping up to COMPACT_BYTES more than needed so it isn't rewritten for every message once full
+# Each record: crc32, payload length, epoch time, topic length, then topic and payload, a torn last record is ignored
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Queue.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import collections
+import os
+import struct
+import threading
+import time
+import zlib
+
+from RR_Timing import timings
+
+RECORD = struct.Struct("<IIdH")
+HEAD = struct.Struct("<Q")
+
+MAX_BYTES = 1024 * 1024
+# Compact once delivered records take up more than this and half of the file
+COMPACT_BYTES = 64 * 1024
+# Longest time the head offset is kept only in memory, so the SD card isn't written for every delivery
+HEAD_SYNC = 10
+
+
+class DiskQueue:
+    """Append-only segment file of (topic, payload, timestamp) records with a delivered head offset"""
+
+    def __init__(self, file_name, max_bytes=MAX_BYTES):
+        self.file_name = file_name
+        self.head_file = file_name + ".head"
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # Offset of the oldest record not yet delivered, and of the next record to send
+        self.head = 0
+        self.cursor = 0
+        # Bytes removed from the front of the file by compaction, so tokens stay valid across compactions
+        self.base = 0
+        # Tokens (base + record end offsets) sent but not acknowledged, in send order, with their acknowledged flag
+        self.sent = collections.OrderedDict()
+        self.head_synced = time.monotonic()
+
+        try:
+            with open(self.head_file, "rb") as head_file:
+                self.head = HEAD.unpack(head_file.read(HEAD.size))[0]
+        except (OSError, struct.error):
+            self.head = 0
+        self.file = open(file_name, "a+b")
+        self.count, self.size = self._recover()
+        self.cursor = self.head
+
+    def _recover(self):
+        # Counts the records from head, truncating a torn or corrupt tail (e.g. power lost mid-write)
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        if self.head > end:
+            self.head = 0
+        offset = self.head
+        count = 0
+        while offset < end:
+            record = self._read(offset)
+            if record is None:
+                timings.count('queue_truncated')
+                self.file.truncate(offset)
+                break
+            offset = record[0]
+            count += 1
+        return count, offset
+
+    def _read(self, offset):
+        # Returns (end offset, topic, payload, timestamp), or None if not a complete valid record
+        self.file.seek(offset)
+        header = self.file.read(RECORD.size)
+        if len(header) < RECORD.size:
+            return None
+        crc, length, timestamp, topic_length = RECORD.unpack(header)
+        body = self.file.read(topic_length + length)
+        if len(body) < topic_length + length or zlib.crc32(header[4:] + body) != crc:
+            return None
+        return (offset + RECORD.size + topic_length + length, body[:topic_length].decode(),
+                body[topic_length:], timestamp)
+
+    def __len__(self):
+        return self.count
+
+    def put(self, topic, payload, timestamp=None):
+        """Appends a message, timestamp (epoch seconds) defaults to now"""
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode()
+        body = RECORD.pack(0, len(payload), time.time() if timestamp is None else timestamp, len(topic))[4:] + \
+            topic + payload
+        with self.lock:
+            if self.size + len(body) + 4 > self.max_bytes:
+                # The file, delivered records included, would be too big: drop the oldest records to make room for
+                # a while, then compact them away. A later ack of one being sent is ignored
+                room = len(body) + 4 + min(COMPACT_BYTES, self.max_bytes // 4)
+                while self.size - self.head + room > self.max_bytes and self.count:
+                    record = self._read(self.head)
+                    self.sent.pop(self.base + record[0], None)
+                    self.head = record[0]
+                    self.cursor = max(self.cursor, self.head)
+                    self.count -= 1
+                    timings.count('queue_dropped')
+                self._compact(force=True)
+            else:
+                self._compact()
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(struct.pack("<I", zlib.crc32(body)) + body)
+            self.file.flush()
+            self.size = self.file.tell()
+            self.count += 1
+            timings.count('queue_put')
+
+    def next(self):
+        """Returns the oldest unsent (token, topic, payload, timestamp), or None"""
+        with self.lock:
+            if self.cursor >= self.size:
+                return None
+            record = self._read(self.cursor)
+            if record is None:
+                return None
+            self.cursor = record[0]
+            token = self.base + record[0]
+            self.sent[token] = False
+            return (token,) + record[1:]
+
+    def ack(self, token):
+        """Marks a record as delivered, the head moves past all leading delivered records"""
+        with self.lock:
+            if token not in self.sent:
+                return
+            self.sent[token] = True
+            while self.sent and next(iter(self.sent.values())):
+                self.head = self.sent.popitem(last=False)[0] - self.base
+                self.count -= 1
+                timings.count('queue_sent')
+            self._compact()
+            if time.monotonic() - self.head_synced >= HEAD_SYNC:
+                self._write_head()
+
+    def rewind(self):
+        """Sends all records not yet acknowledged again, e.g. after a disconnect"""
+        with self.lock:
+            self.sent.clear()
+            self.cursor = self.head
+
+    def _compact(self, force=False):
+        # Records in flight keep their tokens, as base grows by the bytes removed
+        if not self.head:
+            return
+        if self.head >= self.size:
+            self.file.truncate(0)
+        elif force or self.head > COMPACT_BYTES and self.head * 2 > self.size:
+            with timings.stage('queue_compact'):
+                self.file.seek(self.head)
+                remaining = self.file.read()
+                temp_name = self.file_name + ".tmp"
+                with open(temp_name, "wb") as temp_file:
+                    temp_file.write(remaining)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                # Head offset 0 first, so a crash before the replace sends delivered records again rather than
+                # leaving an old head offset pointing into the new file
+                self._write_head(0, durable=True)
+                # Atomic, a crash leaves either the old or the new file
+                os.replace(temp_name, self.file_name)
+                self.file.close()
+                self.file = open(self.file_name, "a+b")
+        else:
+            return
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+        self.base += self.head
+        self.cursor -= self.head
+        self.head = 0
+        self._write_head()
+
+    def _write_head(self, head=None, durable=False):
+        with open(self.head_file, "wb") as head_file:
+            head_file.write(HEAD.pack(self.head if head is None else head))
+            if durable:
+                head_file.flush()
+                os.fsync(head_file.fileno())
+        self.head_synced = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self._write_head()
+            self.file.close()
+
+
+# Test queueing, partial delivery, restart and compaction
+if __name__ == "__main__":
+    test_file = "RR_Queue_test.queue"
+    queue = DiskQueue(test_file, max_bytes=200 * 1024)
+    start = time.perf_counter()
+    for message in range(5000):
+        queue.put("test/RedReactor/Data", '{"RR_volts": 3.9, "RR_current": 500, "message": %d}' % message)
+    print("RR_Queue : queued {} in {:.1f}ms, {} bytes".format(len(queue), (time.perf_counter() - start) * 1000,
+                                                              queue.size))
+    for message in range(1000):
+        queue.ack(queue.next()[0])
+    # Sent but not acknowledged before the restart, so sent again
+    queue.next()
+    queue.close()
+
+    queue = DiskQueue(test_file, max_bytes=200 * 1024)
+    first = queue.next()
+    print("RR_Queue : after restart {} queued, next is {}".format(len(queue), first[2][-15:]))
+    queue.ack(first[0])
+    while True:
+        record = queue.next()
+        if record is None:
+            break
+        queue.ack(record[0])
+    print("RR_Queue : drained, {} queued, file {} bytes".format(len(queue), os.path.getsize(test_file)))
+    queue.close()
+    print(timings.report())
+    for suffix in ("", ".head"):
+        os.remove(test_file + suffix)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Time limited I2C reads and a sample watchdog, so a hung bus can't silently stop battery monitoring
+
+# ina = BoundedI2C(connect) wraps the INA219 made by connect(), e.g. ina.voltage() as before
+#   Each call runs on a worker thread and raises BusTimeout (an OSError) if it takes longer than READ_TIMEOUT
+#   Failed calls are retried RETRIES times with doubling BACKOFF, re-opening the bus with connect() before each retry
+# watchdog = Watchdog(period, escalate=...) then watchdog.start(), and watchdog.kick() after every good sample
+#   escalate(seconds) is called once no good sample has arrived for WATCHDOG_PERIODS periods
+#   Under systemd (WatchdogSec= in the service file) WATCHDOG=1 is sent while samples arrive,
+#   so a stall restarts the service
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Watchdog.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import os
+import queue
+import socket
+import threading
+import time
+
+from RR_Timing import timings
+
+# An INA219 read takes ~1ms, allow for a busy bus
+# RR_I2CLock's LOCK_TIMEOUT allows for the worst case of these, change both together
+READ_TIMEOUT = 0.5
+RETRIES = 2
+BACKOFF = 0.1
+
+# Escalate after this many sample periods without a good reading
+WATCHDOG_PERIODS = 6
+
+
+class BusTimeout(OSError):
+    """I2C call did not complete within the time limit"""
+
+
+class BoundedI2C:
+    """Proxy for an I2C device whose calls are time limited, retried with backoff and re-initialised on failure"""
+
+    def __init__(self, connect, timeout=READ_TIMEOUT, retries=RETRIES, backoff=BACKOFF):
+        self.connect = connect
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.worker = None
+        self.requests = None
+        # Raises OSError as before if the device can't be reached
+        self.device = self._bounded(connect)
+
+    def __getattr__(self, name):
+        # Only called for names not found on the proxy, i.e. the device methods and constants
+        if name == 'device':
+            raise AttributeError(name)
+        attribute = getattr(self.device, name)
+        if not callable(attribute):
+            return attribute
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+
+    def call(self, name, *args, **kwargs):
+        """Calls the device method, other exceptions (e.g. DeviceRangeError) are raised straight away"""
+        delay = self.backoff
+        for attempt in range(self.retries + 1):
+            if attempt:
+                timings.count('i2c_retry')
+                time.sleep(delay)
+                delay *= 2
+                self.reset()
+            try:
+                return self._bounded(lambda: getattr(self.device, name)(*args, **kwargs))
+            except OSError as error:
+                timings.count('i2c_error')
+                last_error = error
+        raise last_error
+
+    def reset(self):
+        """Re-opens the bus and re-configures the device, the nearest we get to a bus reset"""
+        try:
+            self.device = self._bounded(self.connect)
+            timings.count('i2c_reset')
+        except OSError:
+            timings.count('i2c_reset_error')
+
+    def _bounded(self, function):
+        if self.worker is None:
+            self.requests = queue.SimpleQueue()
+            self.worker = threading.Thread(target=self._work, args=(self.requests,), name="RR_I2C", daemon=True)
+            self.worker.start()
+        reply = [None, None]
+        done = threading.Event()
+        self.requests.put((function, reply, done))
+        if not done.wait(self.timeout):
+            # Leave the hung worker behind, it exits if the call ever returns
+            self.requests.put(None)
+            self.worker = None
+            timings.count('i2c_timeout')
+            raise BusTimeout("I2C call timed out after {}s".format(self.timeout))
+        if reply[1] is not None:
+            raise reply[1]
+        return reply[0]
+
+    @staticmethod
+    def _work(requests):
+        while True:
+            request = requests.get()
+            if request is None:
+                return
+            function, reply, done = request
+            try:
+                reply[0] = function()
+            except Exception as error:
+                reply[1] = error
+            done.set()
+
+
+def sd_notify(state):
+    """Sends a state (e.g. READY=1, WATCHDOG=1) to systemd, returns False if not run by systemd"""
+    address = os.environ.get('NOTIFY_SOCKET')
+    if not address:
+        return False
+    if address.startswith('@'):
+        # Abstract namespace socket
+        address = '\0' + address[1:]
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as notify:
+            notify.connect(address)
+            notify.sendall(state.encode())
+        return True
+    except OSError:
+        return False
+
+
+class Watchdog:
+    """Thread that escalates when no good sample has arrived within periods x period seconds"""
+
+    def __init__(self, period, periods=WATCHDOG_PERIODS, escalate=None):
+        self.period = period
+        self.periods = periods
+        self.escalate = escalate
+        self.last_good = time.monotonic()
+        self.stalled = False
+        self.stop = False
+
+        # Ping systemd at half its watchdog time, else check every period
+        watchdog_usec = os.environ.get('WATCHDOG_USEC')
+        self.ping_interval = int(watchdog_usec) / 2e6 if watchdog_usec else None
+
+    def start(self):
+        sd_notify("READY=1")
+        threading.Thread(target=self._run, name="RR_Watchdog", daemon=True).start()
+
+    def kick(self):
+        """Call after every good sample"""
+        self.last_good = time.monotonic()
+        if self.stalled:
+            self.stalled = False
+            timings.count('watchdog_recovered')
+
+    def _run(self):
+        while not self.stop:
+            time.sleep(min(self.period, self.ping_interval) if self.ping_interval else self.period)
+            age = time.monotonic() - self.last_good
+            if age < self.period * self.periods:
+                sd_notify("WATCHDOG=1")
+            elif not self.stalled:
+                # Escalate once per stall, systemd pings stop so WatchdogSec restarts the service
+                self.stalled = True
+                timings.count('watchdog_stall')
+                if self.escalate is not None:
+                    self.escalate(age)
+
+
+# Test a hung device call
+if __name__ == "__main__":
+
+    class HangingDevice:
+        hang = False
+
+        def voltage(self):
+            if HangingDevice.hang:
+                time.sleep(60)
+            return 3.9
+
+    device = BoundedI2C(HangingDevice, timeout=0.2, retries=1)
+    print("RR_Watchdog : voltage", device.voltage())
+    HangingDevice.hang = True
+    start = time.monotonic()
+    try:
+        device.voltage()
+    except OSError as error:
+        print("RR_Watchdog : {} ({:.2f}s)".format(error, time.monotonic() - start))
+    HangingDevice.hang = False
+    print("RR_Watchdog : voltage", device.voltage())
+
+    watchdog = Watchdog(0.1, 3, lambda age: print("RR_Watchdog : no good sample for {:.1f}s".format(age)))
+    watchdog.start()
+    time.sleep(0.6)
+    print(timings.report())
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Keeps the shared helper modules in the application folders the same as the master copy in this folder
+
+# Each application folder has its own copy of the helpers it uses, so it can be installed on its own
+# Change only the copy in this folder, then update the application folders with:
+# python3 RR_Shared.py --copy
+# python3 RR_Shared.py (or --check) lists any copy that differs, exit code 1 if there is one
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Shared.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import argparse
+import filecmp
+import os
+import shutil
+import sys
+
+# Master copy (in this folder) -> application folders with a copy
+SHARED = {
+    "RR_Timing.py": ("RR_BatMonitor", "RR_BatWay", "RR_MQTT", "RR_WebMonitor"),
+    "RR_I2CLock.py": ("RR_BatMonitor", "RR_BatWay", "RR_MQTT", "RR_WebMonitor"),
+    "RR_Watchdog.py": ("RR_BatMonitor", "RR_MQTT"),
+    "RR_SysHealth.py": ("RR_BatWay", "RR_MQTT", "RR_WebMonitor"),
+}
+
+
+def differing(root):
+    """Returns (master, copy) paths of the copies that are missing or differ from the master"""
+    result = []
+    for name, folders in SHARED.items():
+        master = os.path.join(root, name)
+        for folder in folders:
+            copy = os.path.join(root, folder, name)
+            if not os.path.exists(copy) or not filecmp.cmp(master, copy, shallow=False):
+                result.append((master, copy))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check or update the shared Red Reactor helper module copies")
+    parser.add_argument('--copy', action='store_true', help="copy the master modules to the application folders")
+    parser.add_argument('--check', action='store_true', help="only list the copies that differ (default)")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.realpath(__file__))
+    copying = args.copy and not args.check
+    stale = differing(root)
+    for master, copy in stale:
+        if copying:
+            shutil.copy2(master, copy)
+            print("RR_Shared : updated {}".format(os.path.relpath(copy, root)))
+        else:
+            print("RR_Shared : {} differs from {}".format(os.path.relpath(copy, root), os.path.relpath(master, root)))
+    if not stale:
+        print("RR_Shared : all {} copies match".format(sum(len(folders) for folders in SHARED.values())))
+    return 1 if stale and not copying else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Cached CPU temperature and throttle status, shared by all users within the application
+
+# Temperature is read from /sys/class/thermal, throttle flags from the VideoCore mailbox (/dev/vcio)
+# Falls back to a single 'vcgencmd get_throttled' call if the mailbox is not available
+# Values are refreshed at most once per interval, all other calls are served from memory
+
+# Throttle flags (as vcgencmd get_throttled):
+# 0x0 0001 - under-voltage
+# 0x0 0002 - currently throttled
+# 0x0 0004 - arm frequency capped
+# 0x0 0008 - soft temperature limit reached
+# 0x1 0000 - under-voltage has occurred since last reboot
+# 0x2 0000 - throttling has occurred since last reboot
+# 0x4 0000 - arm frequency cap has occurred since last reboot
+# 0x8 0000 - soft temperature limit reached since last reboot
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_SysHealth.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import os
+import struct
+import subprocess
+import threading
+import time
+from array import array
+
+THERMAL_ZONE = "/sys/class/thermal/thermal_zone0/temp"
+VCIO_DEVICE = "/dev/vcio"
+
+# Mailbox property interface, _IOWR(100, 0, char *)
+IOCTL_MBOX_PROPERTY = (3 << 30) | (struct.calcsize("P") << 16) | (100 << 8)
+TAG_GET_THROTTLED = 0x00030046
+MBOX_SUCCESS = 0x80000000
+
+
+class SysHealth:
+    """Reads CPU temperature and throttle flags, at most once per interval"""
+
+    def __init__(self, interval=5):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.last_read = None
+
+        # None if not available
+        self.temperature = None
+        self.throttled = None
+
+        # Mailbox file descriptor, kept open once it works
+        self.vcio = None
+        self.use_mailbox = True
+
+    def read(self):
+        """Returns (temperature in degrees C, throttle flags) from cache, refreshing if older than interval"""
+        with self.lock:
+            if self.last_read is None or time.monotonic() - self.last_read >= self.interval:
+                self.temperature = self._read_temperature()
+                self.throttled = self._read_throttled()
+                self.last_read = time.monotonic()
+            return self.temperature, self.throttled
+
+    @staticmethod
+    def _read_temperature():
+        try:
+            with open(THERMAL_ZONE) as thermal:
+                return int(thermal.read()) / 1000
+        except (OSError, ValueError):
+            return None
+
+    def _read_throttled(self):
+        if self.use_mailbox:
+            try:
+                return self._mailbox_throttled()
+            except OSError:
+                # e.g. no /dev/vcio access, use vcgencmd from now on
+                self.use_mailbox = False
+        try:
+            cpu_data = subprocess.run(['vcgencmd', 'get_throttled'], stdout=subprocess.PIPE, timeout=2)
+            return int(cpu_data.stdout.decode().split("=")[1], 16)
+        except (OSError, IndexError, ValueError, subprocess.SubprocessError):
+            return None
+
+    def _mailbox_throttled(self):
+        # Import here, only available on Linux
+        import fcntl
+
+        if self.vcio is None:
+            self.vcio = os.open(VCIO_DEVICE, os.O_RDONLY)
+        # Buffer size, request, tag, value size, tag request, value, end tag
+        message = array('I', [7 * 4, 0, TAG_GET_THROTTLED, 4, 0, 0, 0])
+        fcntl.ioctl(self.vcio, IOCTL_MBOX_PROPERTY, message, True)
+        if message[1] != MBOX_SUCCESS:
+            raise OSError("VideoCore mailbox request failed")
+        return message[5]
+
+
+def throttled_text(throttled):
+    """Formats throttle flags as shown by vcgencmd, e.g. 0x50000"""
+    return "Unknown" if throttled is None else "{:#x}".format(throttled)
+
+
+# Shared collector for all users within the application
+health = SysHealth()
+
+
+# Test SysHealth
+if __name__ == "__main__":
+    for reading in range(3):
+        start = time.perf_counter()
+        temperature, throttled = health.read()
+        print("RR_SysHealth : Temp {}, Throttled {} in {:.3f}ms".format(temperature, throttled_text(throttled),
+                                                                        (time.perf_counter() - start) * 1000))
@@ -24,7 +24,14 @@
 #include <syslog.h>
 #include <unistd.h>
 #include <math.h>
+#include <time.h>   // clock_nanosleep for drift-free sampling
+#include <errno.h>
+#include <stdint.h> // int64_t
+#include <fcntl.h>
+#include <sys/file.h>   // flock, shares the I2C bus with the Python monitors
+#include <sys/stat.h>
 #include <map>
+#include <string>   // std::string, std::to_string
 #include "src/ina219.h"
 
 // For interactive testing output to terminal, use: make debug
@@ -50,6 +57,30 @@ const float BATTERY_VMIN = 2.9;     // Increase this to force earlier shutdown
 // Write data to device driver file
 const char *outputFile = "/dev/redreactor";
 
+// Advisory lock shared with the Python monitors (RR_I2CLock.py) around each bus transaction
+const char *lockFile = "/run/lock/redreactor-i2c.lock";
+const float LOCK_TIMEOUT = 3800.0;  // ms, then read anyway so a stuck client can't stop monitoring
+                                    // as RR_I2CLock.py, longer than a Python monitor's failing transaction
+
+// Sample lateness histogram, bucket upper bounds in ms (last bucket counts anything later)
+const float LATE_BUCKETS[] = {0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500};
+const int LATE_COUNT = sizeof(LATE_BUCKETS) / sizeof(LATE_BUCKETS[0]);
+
+struct tickStats {
+    long ticks;
+    long skipped;       // whole intervals missed when a sample overran
+    float late_sum;     // ms
+    float late_max;     // ms
+    long buckets[LATE_COUNT + 1];
+    long lock_contended; // transactions that had to wait for another monitor
+    long lock_timeouts;
+    float lock_wait_sum; // ms
+    float lock_wait_max; // ms
+} tickResults;
+
+// Set by SIGUSR1, the timing summary is then written to syslog from the main loop
+volatile sig_atomic_t reportTimings = 0;
+
 struct avSamples {
     // float is sufficient accuracy
     float voltage;
@@ -95,6 +126,103 @@ void sampleAverages(float newVoltage, float newCurrent) {
 
 }
 
+// Milliseconds between two monotonic times
+float elapsedMs(const struct timespec *from, const struct timespec *to) {
+    return (to->tv_sec - from->tv_sec) * 1000.0 + (to->tv_nsec - from->tv_nsec) / 1000000.0;
+}
+
+// Advance a timespec by ms
+// Whole seconds are added first, as ms in ns overflows a 32-bit long above about 2147ms
+void addInterval(struct timespec *t, float ms) {
+    time_t secs = (time_t)(ms / 1000);
+    t->tv_sec += secs;
+    int64_t ns = t->tv_nsec + (int64_t)((ms - secs * 1000.0) * 1000000);
+    t->tv_sec += ns / 1000000000;
+    t->tv_nsec = ns % 1000000000;
+}
+
+// Sleep until the absolute deadline, so the sample period doesn't drift by the work time
+// Records how late the wake up was and skips whole intervals that have already passed
+void waitInterval(struct timespec *deadline) {
+    struct timespec now;
+
+    addInterval(deadline, INTERVAL);
+    while (clock_nanosleep(CLOCK_MONOTONIC, TIMER_ABSTIME, deadline, NULL) == EINTR) {
+        // Interrupted by a signal, e.g. SIGUSR1
+    }
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    float late = elapsedMs(deadline, &now);
+    if (late >= INTERVAL) {
+        long missed = (long)(late / INTERVAL);
+        tickResults.skipped += missed;
+        addInterval(deadline, missed * INTERVAL);
+        late -= missed * INTERVAL;
+    }
+
+    int bucket = 0;
+    while (bucket < LATE_COUNT && late > LATE_BUCKETS[bucket]) {
+        bucket++;
+    }
+    tickResults.buckets[bucket]++;
+    tickResults.ticks++;
+    tickResults.late_sum += late;
+    if (late > tickResults.late_max) {
+        tickResults.late_max = late;
+    }
+}
+
+// Wait (bounded) for exclusive use of the I2C bus, returns true if locked
+bool lockBus(int lockFd) {
+    struct timespec start, now;
+    bool contended = false;
+    bool locked = false;
+
+    if (lockFd < 0) {
+        return false;
+    }
+    clock_gettime(CLOCK_MONOTONIC, &start);
+    while (true) {
+        if (flock(lockFd, LOCK_EX | LOCK_NB) == 0) {
+            locked = true;
+            break;
+        }
+        clock_gettime(CLOCK_MONOTONIC, &now);
+        if (errno != EWOULDBLOCK || elapsedMs(&start, &now) >= LOCK_TIMEOUT) {
+            tickResults.lock_timeouts++;
+            break;
+        }
+        contended = true;
+        usleep(1000);
+    }
+    clock_gettime(CLOCK_MONOTONIC, &now);
+    float wait = elapsedMs(&start, &now);
+    if (contended) {
+        tickResults.lock_contended++;
+    }
+    tickResults.lock_wait_sum += wait;
+    if (wait > tickResults.lock_wait_max) {
+        tickResults.lock_wait_max = wait;
+    }
+    return locked;
+}
+
+// Write sample timing summary to syslog
+void logTimings() {
+    std::string counts;
+    for (int bucket = 0; bucket <= LATE_COUNT; bucket++) {
+        counts += (bucket ? " " : "") + std::to_string(tickResults.buckets[bucket]);
+    }
+    syslog(LOG_INFO, "RR-Driver samples %ld, skipped %ld, lateness ms mean %.3f max %.3f, buckets [%s]",
+           tickResults.ticks, tickResults.skipped,
+           tickResults.ticks ? tickResults.late_sum / tickResults.ticks : 0.0, tickResults.late_max, counts.c_str());
+    syslog(LOG_INFO, "RR-Driver I2C lock contended %ld, timeouts %ld, wait ms total %.3f max %.3f",
+           tickResults.lock_contended, tickResults.lock_timeouts, tickResults.lock_wait_sum, tickResults.lock_wait_max);
+}
+
+void timings_handler(int s) {
+    reportTimings = 1;
+}
+
 void my_handler(sig_atomic_t s) {
            std::cout << "Abort Signal " << s << std::endl;
            syslog(LOG_INFO, "RR-Driver aborting");
@@ -114,6 +242,8 @@ int main()
 
     // Detect abort signal (incl. CTRL-C)
     signal (SIGINT, my_handler);
+    // kill -USR1 <pid> writes the sample timing summary to syslog
+    signal (SIGUSR1, timings_handler);
     
     // Log main events [start, charging -> full -> discharging -> empty -> shutdown]
     enum batStates {
@@ -170,15 +300,32 @@ int main()
         syslog(LOG_ERR, "RR-Driver Unable to write initialisation to device file");
     }
     
+    // Open the I2C lock file, carry on without it if /run/lock isn't available
+    int lockFd = open(lockFile, O_RDWR | O_CREAT, 0666);
+    if (lockFd < 0) {
+        syslog(LOG_WARNING, "RR-Driver Unable to open %s, not locking", lockFile);
+    } else {
+        // Python monitors may run as another user
+        fchmod(lockFd, 0666);
+    }
+
     // Start loop to monitor battery
     DEBUG_STDOUT("time_s\tV_Sup\tA_mA\tV_av\tA_av\tCap\tC-Vmax\tF-Vmax");
     int sample = 0;
+    struct timespec deadline;
+    clock_gettime(CLOCK_MONOTONIC, &deadline);
     while (true)
     {
+        // Hold the bus for the whole transaction, another monitor may have put the device to sleep
+        bool locked = lockBus(lockFd);
+        redreactor.wake();
         float voltage = redreactor.supply_voltage();
         // Positive = discharge, Negative = Charge
         // Note, values <=10mA are at Battery FULL, >10mA is no external power
         float current = redreactor.current();
+        if (locked) {
+            flock(lockFd, LOCK_UN);
+        }
         // Updates avResults
         sampleAverages(voltage, current);
         
@@ -297,8 +444,13 @@ int main()
             break;
         }
 
+        if (reportTimings) {
+            reportTimings = 0;
+            logTimings();
+        }
+
         // Optional: use redreactor.sleep() and redreactor.wake()
-        usleep(INTERVAL * 1000);
+        waitInterval(&deadline);
 
         sample++;
 
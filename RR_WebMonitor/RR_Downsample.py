@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Reduces long sample histories to a fixed number of points for RR_Plotgraphs and the JSON history
+
+# lttb   : Largest-Triangle-Three-Buckets, keeps the visual shape of the line
+# minmax : min/max envelope, keeps every peak (e.g. current spikes) in each bucket
+# Both run in linear time and return the indices of the selected samples
+# numpy is only imported when first used, set use_numpy = False (lite mode) for the pure Python versions
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Downsample.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Default point budget, roughly one point per horizontal pixel of the 500px wide graph
+PLOT_POINTS = 400
+
+# Lite mode clears this to avoid loading numpy
+use_numpy = True
+
+
+def lttb(x, y, n_out: int = PLOT_POINTS):
+    """Largest-Triangle-Three-Buckets downsampling
+    :param
+    x = sample positions (monotonic)
+    y = sample values, same length as x
+    n_out = number of points to keep (first and last are always kept)
+
+    Returns numpy array of the selected sample indices
+    """
+
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    # Split the middle points into n_out - 2 buckets (each at least one sample wide)
+    edges = 1 + np.arange(n_out - 1) * (n - 2) // (n_out - 2)
+
+    # Bucket averages in one pass using cumulative sums
+    cum_x = np.concatenate(([0.0], np.cumsum(x)))
+    cum_y = np.concatenate(([0.0], np.cumsum(y)))
+    counts = edges[1:] - edges[:-1]
+    avg_x = (cum_x[edges[1:]] - cum_x[edges[:-1]]) / counts
+    avg_y = (cum_y[edges[1:]] - cum_y[edges[:-1]]) / counts
+    # Each bucket looks ahead to the next bucket average, the last bucket to the last point
+    next_x = np.append(avg_x[1:], x[-1])
+    next_y = np.append(avg_y[1:], y[-1])
+
+    selected = np.empty(n_out, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    a = 0
+    for bucket in range(n_out - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        # Triangle area (x2) between last selected point, each candidate and next bucket average
+        area = np.abs((x[a] - next_x[bucket]) * (y[lo:hi] - y[a])
+                      - (x[a] - x[lo:hi]) * (next_y[bucket] - y[a]))
+        a = lo + int(np.argmax(area))
+        selected[bucket + 1] = a
+
+    return selected
+
+
+def minmax(y, n_out: int = PLOT_POINTS):
+    """Min/max envelope downsampling, keeps the lowest and highest sample of each bucket
+    :param
+    y = sample values
+    n_out = maximum number of points to keep (2 per bucket)
+
+    Returns numpy array of the selected sample indices, in time order
+    """
+
+    import numpy as np
+
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    buckets = n_out // 2
+    if n_out >= n or buckets < 1:
+        return np.arange(n)
+
+    # Equal sized buckets, last one padded with its final value
+    width = -(-n // buckets)
+    buckets = -(-n // width)
+    padded = np.pad(y, (0, buckets * width - n), mode='edge').reshape(buckets, width)
+    offsets = np.arange(buckets) * width
+    i_min = offsets + np.argmin(padded, axis=1)
+    i_max = offsets + np.argmax(padded, axis=1)
+
+    # Keep time order within each bucket, drop duplicates (flat buckets)
+    selected = np.stack((np.minimum(i_min, i_max), np.maximum(i_min, i_max)), axis=1).ravel()
+    return np.unique(selected)
+
+
+def lttb_list(y, n_out: int = PLOT_POINTS):
+    """Pure Python lttb, using the sample index as x. Returns list of the selected sample indices"""
+
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        return list(range(n))
+
+    # Bucket edges as lttb
+    edges = [1 + bucket * (n - 2) // (n_out - 2) for bucket in range(n_out - 1)]
+    selected = [0]
+    a = 0
+    for bucket in range(n_out - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        # Average of the next bucket, or the last point for the last bucket
+        if bucket == n_out - 3:
+            next_x, next_y = n - 1, y[-1]
+        else:
+            next_lo, next_hi = hi, edges[bucket + 2]
+            next_x = (next_lo + next_hi - 1) / 2
+            next_y = sum(y[next_lo:next_hi]) / (next_hi - next_lo)
+
+        best_area = -1
+        for index in range(lo, hi):
+            area = abs((a - next_x) * (y[index] - y[a]) - (a - index) * (next_y - y[a]))
+            if area > best_area:
+                best_area = area
+                best = index
+        a = best
+        selected.append(a)
+
+    selected.append(n - 1)
+    return selected
+
+
+def minmax_list(y, n_out: int = PLOT_POINTS):
+    """Pure Python minmax. Returns list of the selected sample indices, in time order"""
+
+    n = len(y)
+    buckets = n_out // 2
+    if n_out >= n or buckets < 1:
+        return list(range(n))
+
+    width = -(-n // buckets)
+    selected = []
+    for lo in range(0, n, width):
+        hi = min(lo + width, n)
+        i_min = min(range(lo, hi), key=y.__getitem__)
+        i_max = max(range(lo, hi), key=y.__getitem__)
+        selected.extend(sorted({i_min, i_max}))
+    return selected
+
+
+def downsample(y, n_out: int = PLOT_POINTS, method: str = 'lttb'):
+    """Returns lists of (indices, values) of y reduced to n_out points using the given method"""
+
+    if use_numpy:
+        import numpy as np
+
+        y = np.asarray(y, dtype=float)
+        if method == 'minmax':
+            selected = minmax(y, n_out)
+        else:
+            selected = lttb(np.arange(len(y)), y, n_out)
+        return selected.tolist(), y[selected].tolist()
+
+    y = list(y)
+    selected = minmax_list(y, n_out) if method == 'minmax' else lttb_list(y, n_out)
+    return selected, [y[index] for index in selected]
+
+
+# Test downsampling functions
+if __name__ == "__main__":
+    import time
+    import numpy as np
+
+    samples = 17280
+    test_x = np.arange(samples)
+    test_y = 3.7 + 0.4 * np.sin(test_x / 500) + np.random.normal(0, 0.01, samples)
+    test_y[9000] = 2.5
+
+    start = time.perf_counter()
+    lttb_idx = lttb(test_x, test_y)
+    print("RR_Downsample : lttb {} -> {} points in {:.1f}ms, kept spike: {}".format(
+        samples, len(lttb_idx), (time.perf_counter() - start) * 1000, 9000 in lttb_idx))
+
+    start = time.perf_counter()
+    minmax_idx = minmax(test_y)
+    print("RR_Downsample : minmax {} -> {} points in {:.1f}ms, kept spike: {}".format(
+        samples, len(minmax_idx), (time.perf_counter() - start) * 1000, 9000 in minmax_idx))
+
+    start = time.perf_counter()
+    lttb_idx = lttb_list(test_y.tolist())
+    print("RR_Downsample : lttb_list {} -> {} points in {:.1f}ms, kept spike: {}".format(
+        samples, len(lttb_idx), (time.perf_counter() - start) * 1000, 9000 in lttb_idx))
+
+    start = time.perf_counter()
+    minmax_idx = minmax_list(test_y.tolist())
+    print("RR_Downsample : minmax_list {} -> {} points in {:.1f}ms, kept spike: {}".format(
+        samples, len(minmax_idx), (time.perf_counter() - start) * 1000, 9000 in minmax_idx))
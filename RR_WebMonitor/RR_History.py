@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Long term battery history for RR_WebMonitor, stored in an SQLite database (WAL mode)
+
+# Every sample is stored in the samples table (kept for RAW_DAYS)
+# and rolled up incrementally into 1 minute, 1 hour and 1 day buckets (min, max, mean, energy)
+# Range queries use the (resolution, bucket) primary key, so stay fast however long it has been recording
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_History.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import sqlite3
+import threading
+import time
+
+# Rollup resolutions in seconds, and how many days to keep (None = forever)
+RESOLUTIONS = (60, 3600, 86400)
+KEEP_DAYS = {0: 7, 60: 90, 3600: None, 86400: None}
+
+# Battery status stored as a small integer
+STATUS = ("FULL", "CHARGING", "DISCHARGING", "FAULT")
+
+# Ignore gaps longer than this when integrating energy (e.g. after a restart)
+MAX_GAP = 60
+
+# Limit SD card writes, commit at most every COMMIT_INTERVAL seconds
+COMMIT_INTERVAL = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    ts REAL PRIMARY KEY,
+    volts REAL, current REAL, temp REAL, status INTEGER
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    res INTEGER, bucket INTEGER, n INTEGER,
+    v_min REAL, v_max REAL, v_sum REAL,
+    i_min REAL, i_max REAL, i_sum REAL,
+    t_min REAL, t_max REAL, t_sum REAL,
+    energy REAL,
+    t_n INTEGER,
+    PRIMARY KEY (res, bucket)
+) WITHOUT ROWID;
+"""
+
+# Samples without a CPU temperature (None) are left out of the temperature columns, t_n counts those with one
+# (NULL in buckets from before t_n was added, which counted all n)
+UPSERT = """
+INSERT INTO rollups (res, bucket, n, v_min, v_max, v_sum, i_min, i_max, i_sum, t_min, t_max, t_sum, energy, t_n)
+VALUES (?, ?, 1, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (res, bucket) DO UPDATE SET
+    n = n + 1,
+    v_min = min(v_min, excluded.v_min), v_max = max(v_max, excluded.v_max), v_sum = v_sum + excluded.v_sum,
+    i_min = min(i_min, excluded.i_min), i_max = max(i_max, excluded.i_max), i_sum = i_sum + excluded.i_sum,
+    t_min = COALESCE(min(t_min, excluded.t_min), t_min, excluded.t_min),
+    t_max = COALESCE(max(t_max, excluded.t_max), t_max, excluded.t_max),
+    t_sum = COALESCE(t_sum + excluded.t_sum, t_sum, excluded.t_sum),
+    t_n = COALESCE(t_n, n) + excluded.t_n,
+    energy = energy + excluded.energy
+"""
+
+
+class RRHistory:
+    """Time-series store for battery samples with 1 minute, 1 hour and 1 day rollups"""
+
+    def __init__(self, db_file="RR_History.db", read_only=False):
+        # One connection shared by the battery thread and web requests
+        self.lock = threading.Lock()
+        if read_only:
+            # For other processes (e.g. the rr command), queries only, raises sqlite3.Error if there is no database
+            self.db = sqlite3.connect("file:{}?mode=ro".format(db_file), uri=True, check_same_thread=False)
+        else:
+            self.db = sqlite3.connect(db_file, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.executescript(SCHEMA)
+            if not self._has_t_n():
+                self.db.execute("ALTER TABLE rollups ADD COLUMN t_n INTEGER")
+        # Temperature sample count, all samples in a database not yet upgraded (read only)
+        self.t_n = "COALESCE(t_n, n)" if self._has_t_n() else "n"
+
+        # Continue energy integration from the last stored sample
+        last = self.db.execute("SELECT ts FROM samples ORDER BY ts DESC LIMIT 1").fetchone()
+        self.last_ts = last[0] if last else 0
+        self.last_commit = time.monotonic()
+        self.last_prune = 0
+
+    def _has_t_n(self):
+        return any(column[1] == 't_n' for column in self.db.execute("PRAGMA table_info(rollups)"))
+
+    def add(self, ts, volts, current, temp, status):
+        """Store one sample (ts in epoch seconds, current in mA) and update the rollups"""
+
+        # Energy from the battery in Wh since the last sample, negative when charging
+        gap = ts - self.last_ts
+        energy = volts * current / 1000 * gap / 3600 if 0 < gap <= MAX_GAP else 0.0
+        status = STATUS.index(status) if status in STATUS else len(STATUS)
+
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?)",
+                            (ts, volts, current, temp, status))
+            self.db.executemany(UPSERT, [(res, int(ts // res) * res,
+                                          volts, volts, volts,
+                                          current, current, current,
+                                          temp, temp, temp,
+                                          energy, 0 if temp is None else 1) for res in RESOLUTIONS])
+            self.last_ts = ts
+
+            if time.monotonic() - self.last_commit >= COMMIT_INTERVAL:
+                self.db.commit()
+                self.last_commit = time.monotonic()
+                # Prune expired data once an hour
+                if ts - self.last_prune >= 3600:
+                    self._prune(ts)
+                    self.last_prune = ts
+
+    def _prune(self, ts):
+        for res, days in KEEP_DAYS.items():
+            if days is None:
+                continue
+            if res == 0:
+                self.db.execute("DELETE FROM samples WHERE ts < ?", (ts - days * 86400,))
+            else:
+                self.db.execute("DELETE FROM rollups WHERE res = ? AND bucket < ?", (res, ts - days * 86400))
+        self.db.commit()
+
+    @staticmethod
+    def resolution(since, until, max_points=2000, interval=5):
+        """Finest resolution (0 = raw samples) giving no more than max_points for the range"""
+        span = max(until - since, 1)
+        if span / interval <= max_points and since >= time.time() - KEEP_DAYS[0] * 86400:
+            return 0
+        for res in RESOLUTIONS:
+            if span / res <= max_points:
+                return res
+        return RESOLUTIONS[-1]
+
+    def query(self, since, until=None, res=None, max_points=2000):
+        """Returns dict of column lists for since <= ts < until at the given (or automatic) resolution
+        Raw samples have ts, volts, current, temp, status
+        Rollups have ts, n, volts (mean), v_min, v_max, current (mean), i_min, i_max, temp (mean), energy (Wh)
+        """
+
+        until = time.time() if until is None else until
+        if res is None:
+            res = self.resolution(since, until, max_points)
+
+        with self.lock:
+            if res == 0:
+                keys = ('ts', 'volts', 'current', 'temp', 'status')
+                rows = self.db.execute("SELECT ts, volts, current, temp, status FROM samples "
+                                       "WHERE ts >= ? AND ts < ? ORDER BY ts", (since, until)).fetchall()
+            else:
+                keys = ('ts', 'n', 'volts', 'v_min', 'v_max', 'current', 'i_min', 'i_max', 'temp', 'energy')
+                rows = self.db.execute("SELECT bucket, n, v_sum / n, v_min, v_max, i_sum / n, i_min, i_max, "
+                                       "t_sum / {}, energy FROM rollups WHERE res = ? AND bucket >= ? AND bucket < ? "
+                                       "ORDER BY bucket".format(self.t_n),
+                                       (res, int(since // res) * res, until)).fetchall()
+
+        columns = {key: list(values) for key, values in zip(keys, zip(*rows))} if rows else {key: [] for key in keys}
+        columns['res'] = res
+        return columns
+
+    def energy(self, since, until=None):
+        """Total energy (Wh) taken from the battery for the range
+        Whole days and hours come from their rollups, the partial ones at each end from finer rollups, and the
+        partial minutes from the raw samples
+        """
+        until = time.time() if until is None else until
+        with self.lock:
+            return self._energy(since, until, len(RESOLUTIONS) - 1)
+
+    def _energy(self, since, until, level):
+        if since >= until:
+            return 0.0
+        if level < 0:
+            # Each sample's energy covers the gap since the sample before, as in add()
+            rows = self.db.execute("SELECT ts, volts, current FROM samples WHERE ts >= ? AND ts < ? ORDER BY ts",
+                                   (since, until)).fetchall()
+            previous = self.db.execute("SELECT ts FROM samples WHERE ts < ? ORDER BY ts DESC LIMIT 1",
+                                       (since,)).fetchone()
+            last_ts = previous[0] if previous else None
+            total = 0.0
+            for ts, volts, current in rows:
+                if last_ts is not None and 0 < ts - last_ts <= MAX_GAP:
+                    total += volts * current / 1000 * (ts - last_ts) / 3600
+                last_ts = ts
+            return total
+        res = RESOLUTIONS[level]
+        # Buckets wholly inside the range
+        first = -(-since // res) * res
+        last = until // res * res
+        if first >= last:
+            return self._energy(since, until, level - 1)
+        total = self.db.execute("SELECT sum(energy) FROM rollups WHERE res = ? AND bucket >= ? AND bucket < ?",
+                                (res, first, last)).fetchone()[0] or 0.0
+        return total + self._energy(since, first, level - 1) + self._energy(last, until, level - 1)
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+
+def parse_since(since, now=None):
+    """Converts '30m', '12h', '7d' (ago) or epoch seconds into epoch seconds"""
+    now = time.time() if now is None else now
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+    if since[-1:] in units:
+        return now - float(since[:-1]) * units[since[-1]]
+    return float(since)
+
+
+# Test history store with simulated data
+if __name__ == "__main__":
+    import os
+
+    test_db = "RR_History_test.db"
+    history = RRHistory(test_db)
+    start_ts = time.time() - 30 * 86400
+    start = time.perf_counter()
+    # 30 days at 60s intervals
+    for sample in range(30 * 1440):
+        history.add(start_ts + sample * 60, 3.7, 500.0, 45.0, "DISCHARGING")
+    print("RR_History : added {} samples in {:.1f}s".format(30 * 1440, time.perf_counter() - start))
+
+    for span in ("1h", "1d", "7d", "30d"):
+        start = time.perf_counter()
+        result = history.query(parse_since(span))
+        print("RR_History : last {} at res {}s: {} points in {:.1f}ms".format(
+            span, result['res'], len(result['ts']), (time.perf_counter() - start) * 1000))
+    print("RR_History : energy over 7 days {:.2f}Wh".format(history.energy(parse_since("7d"))))
+
+    history.close()
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(test_db + suffix):
+            os.remove(test_db + suffix)
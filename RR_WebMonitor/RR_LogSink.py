@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Buffered, size limited log file for RR_WebMonitor, to keep SD card writes down
+
+# Lines are kept in memory and appended in one block every FLUSH_INTERVAL seconds (or FLUSH_BYTES)
+# When the file would exceed MAX_BYTES it is rotated: RR_WebMonitor.log.1.gz (newest) ... .5.gz (oldest)
+# The buffer is written out (and synced) on close, at exit and by the owner on SIGTERM
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_LogSink.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import atexit
+import gzip
+import os
+import shutil
+import threading
+import time
+
+# Defaults: write at most once a minute, keep 5 rotated files of up to 1MB
+FLUSH_INTERVAL = 60
+FLUSH_BYTES = 8192
+MAX_BYTES = 1024 * 1024
+BACKUPS = 5
+
+
+class LogSink:
+    """Log file with in-memory batching, size capped rotation and optional gzip of rotated files"""
+
+    def __init__(self, file_name, max_bytes=MAX_BYTES, backups=BACKUPS, compress=True,
+                 flush_interval=FLUSH_INTERVAL, flush_bytes=FLUSH_BYTES):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.flush_bytes = flush_bytes
+
+        # Written by the battery thread and web requests
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.pending = 0
+        self.last_flush = time.monotonic()
+        self.closed = False
+
+        # Don't lose buffered lines on a normal exit
+        atexit.register(self.close)
+
+    def write(self, text):
+        with self.lock:
+            if self.closed:
+                return
+            self.buffer.append(text)
+            self.pending += len(text)
+            if self.pending >= self.flush_bytes or time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush_if_due(self):
+        # Called periodically, so quiet periods are still written within flush_interval
+        with self.lock:
+            if self.buffer and time.monotonic() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self._flush(sync=True)
+            self.closed = True
+
+    def _flush(self, sync=False):
+        self.last_flush = time.monotonic()
+        if not self.buffer:
+            return
+        data = "".join(self.buffer).encode()
+        self.buffer.clear()
+        self.pending = 0
+        try:
+            size = self._size()
+            if self.max_bytes and size and size + len(data) > self.max_bytes:
+                self._rotate()
+            with open(self.file_name, 'ab') as log_file:
+                log_file.write(data)
+                if sync:
+                    log_file.flush()
+                    os.fsync(log_file.fileno())
+        except OSError as error:
+            # Lines are dropped rather than kept in memory
+            print("RR_LogSink Error:", error)
+
+    def _size(self):
+        try:
+            return os.path.getsize(self.file_name)
+        except OSError:
+            return 0
+
+    def _rotate(self):
+        if self.backups < 1:
+            os.remove(self.file_name)
+            return
+        suffix = ".gz" if self.compress else ""
+        # Shift older files up by one, the oldest is overwritten
+        for index in range(self.backups - 1, 0, -1):
+            older = "{}.{}{}".format(self.file_name, index, suffix)
+            if os.path.exists(older):
+                os.replace(older, "{}.{}{}".format(self.file_name, index + 1, suffix))
+        if self.compress:
+            with open(self.file_name, 'rb') as source, gzip.open(self.file_name + ".1.gz", 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.remove(self.file_name)
+        else:
+            os.replace(self.file_name, self.file_name + ".1")
+
+
+# Test log sink rotation
+if __name__ == "__main__":
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as test_dir:
+        test_log = LogSink(os.path.join(test_dir, "test.log"), max_bytes=20000, backups=3, flush_bytes=4096)
+        start = time.perf_counter()
+        for line in range(5000):
+            test_log.write("{:05d}, 3.70V,  500.00mA, Ext Power: No, Battery at 60%\n".format(line))
+        test_log.close()
+        print("RR_LogSink : wrote 5000 lines in {:.1f}ms".format((time.perf_counter() - start) * 1000))
+        for name in sorted(os.listdir(test_dir)):
+            print("RR_LogSink : {} {} bytes".format(name, os.path.getsize(os.path.join(test_dir, name))))
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Prometheus text format for the RR_WebMonitor /metrics endpoint
+
+# The battery thread encodes a new page after every sample, a scrape just returns those bytes
+# Units follow the Prometheus conventions: volts, amps, watts, seconds, celsius
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Metrics.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def metric(name, kind, help_text, value, label=None):
+    """Returns one metric family as text
+    :param
+    name = metric name, e.g. rr_battery_voltage_volts
+    kind = gauge, counter or summary (value is then (sum, count))
+    value = number, or dict of {label value: number} using label as the label name
+    """
+
+    lines = ["# HELP {} {}\n# TYPE {} {}\n".format(name, help_text, name, kind)]
+    if kind == 'summary':
+        lines.append("{}_sum {}\n{}_count {}\n".format(name, _number(value[0]), name, value[1]))
+    elif isinstance(value, dict):
+        for label_value, number in value.items():
+            lines.append('{}{{{}="{}"}} {}\n'.format(name, label, label_value, _number(number)))
+    else:
+        lines.append("{} {}\n".format(name, _number(value)))
+    return "".join(lines)
+
+
+def histograms(name, help_text, stages, bounds, label='stage'):
+    """Returns one histogram family with a series per stage
+    :param
+    stages = dict of {label value: histogram} with buckets (per bound, then overflow), sum and count
+    bounds = bucket upper bounds in seconds
+    """
+
+    lines = ["# HELP {} {}\n# TYPE {} histogram\n".format(name, help_text, name)]
+    for label_value, histogram in stages.items():
+        total = 0
+        for bound, bucket in zip(bounds, histogram.buckets):
+            total += bucket
+            lines.append('{}_bucket{{{}="{}",le="{}"}} {}\n'.format(name, label, label_value, bound, total))
+        lines.append('{}_bucket{{{}="{}",le="+Inf"}} {}\n'.format(name, label, label_value, histogram.count))
+        lines.append('{}_sum{{{}="{}"}} {}\n'.format(name, label, label_value, _number(histogram.sum)))
+        lines.append('{}_count{{{}="{}"}} {}\n'.format(name, label, label_value, histogram.count))
+    return "".join(lines)
+
+
+def _number(value):
+    # Prometheus accepts ints and floats, booleans as 0/1
+    if isinstance(value, bool):
+        return int(value)
+    return repr(value) if isinstance(value, float) else value
+
+
+def encode(families):
+    """Joins metric families into the bytes returned by /metrics"""
+    return "".join(families).encode()
+
+
+# Show example output
+if __name__ == "__main__":
+    print(encode([metric('rr_battery_voltage_volts', 'gauge', "Battery voltage", 3.912),
+                  metric('rr_battery_status', 'gauge', "Battery status (1 = current status)",
+                         {'FULL': 0, 'CHARGING': 0, 'DISCHARGING': 1, 'FAULT': 0}, 'status'),
+                  metric('rr_graph_render_seconds', 'summary', "Graph drawing time", (1.25, 10))]).decode())
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Creates a x-y plot as SVG image for RR_WebMonitor.py in lite mode (no numpy/matplotlib required)
+
+# Same layout and fixed scales as RR_Plotgraphs, drawn by the browser instead of the Pi
+# Input is lists of Y1 (Volts), Y2 (mA), Temp : length defines number of samples
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_PlotSVG.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import RR_Downsample
+
+# Image size in pixels, as RR_Plotgraphs (5 x 6 inches at 100dpi)
+WIDTH = 500
+HEIGHT = 600
+
+# Plot areas (left, right, top, bottom) for volts/current and temperature
+MAIN = (60, 440, 40, 350)
+TEMP = (60, 440, 420, 550)
+
+
+def _scale(value, low, high, top, bottom):
+    # Maps value between low-high onto pixel rows bottom-top
+    return bottom - (value - low) * (bottom - top) / (high - low)
+
+
+def _polyline(x, y, samples, low, high, area, colour):
+    left, right, top, bottom = area
+    span = max(samples - 1, 1)
+    points = " ".join("{:.1f},{:.1f}".format(left + (right - left) * i / span,
+                                             _scale(min(max(v, low), high), low, high, top, bottom))
+                      for i, v in zip(x, y))
+    return '<polyline points="{}" fill="none" stroke="{}" stroke-width="1.5"/>'.format(points, colour)
+
+
+def _y_axis(low, high, steps, area, colour, right_side=False, grid=True):
+    # Tick labels (and grid lines) for one y-axis
+    left, right, top, bottom = area
+    svg = []
+    for step in range(steps + 1):
+        value = low + (high - low) * step / steps
+        row = _scale(value, low, high, top, bottom)
+        if grid:
+            svg.append('<line x1="{}" y1="{:.1f}" x2="{}" y2="{:.1f}" stroke="#ddd"/>'.format(left, row, right, row))
+        label = "{:g}".format(round(value, 2))
+        if right_side:
+            svg.append('<text x="{}" y="{:.1f}" fill="{}">{}</text>'.format(right + 4, row + 4, colour, label))
+        else:
+            svg.append('<text x="{}" y="{:.1f}" fill="{}" text-anchor="end">{}</text>'.format(left - 4, row + 4,
+                                                                                              colour, label))
+    return svg
+
+
+def _x_axis(samples, area):
+    # Sample number ticks, about 10 per axis
+    left, right, top, bottom = area
+    svg = ['<rect x="{}" y="{}" width="{}" height="{}" fill="none" stroke="black"/>'.format(left, top, right - left,
+                                                                                            bottom - top)]
+    span = max(samples - 1, 1)
+    every = int(span / 10) + 1 if span > 10 else 1
+    for sample in range(0, samples, every):
+        column = left + (right - left) * sample / span
+        svg.append('<text x="{:.1f}" y="{}" text-anchor="middle">{}</text>'.format(column, bottom + 14, sample))
+    svg.append('<text x="{}" y="{}" text-anchor="middle">Time (samples)</text>'.format((left + right) // 2,
+                                                                                       bottom + 30))
+    return svg
+
+
+def rr_plots_svg(y1: list, y2: list, temperature: list, file_name='RR_Status.svg'):
+    """Plots graphs to SVG file for RR_WebMonitor
+    :param
+    y1 = list of voltage samples
+    y2 = list of current samples
+    temperature = list of temperature samples on separate plot
+
+    All lists assumed to be the same length (= number of samples)
+    """
+
+    print("RR_PlotSVG : Plotting samples:", len(y1))
+    samples = len(y1)
+    x1, y1 = RR_Downsample.downsample(y1, RR_Downsample.PLOT_POINTS, 'lttb')
+    x2, y2 = RR_Downsample.downsample(y2, RR_Downsample.PLOT_POINTS, 'minmax')
+    x3, t1 = RR_Downsample.downsample(temperature, RR_Downsample.PLOT_POINTS, 'lttb')
+
+    # For current, set y2-axis scale according to simple usage models (as RR_Plotgraphs)
+    y_min = min(y2) // 500 * 500 if y2 and min(y2) < 0 else 0
+    y_max = 500 if not y2 or max(y2) < 500 else max(y2) // 1000 * 1000 + 1000
+
+    svg = ['<svg xmlns="http://www.w3.org/2000/svg" width="{0}" height="{1}" viewBox="0 0 {0} {1}" '
+           'font-family="sans-serif" font-size="11">'.format(WIDTH, HEIGHT),
+           '<rect width="100%" height="100%" fill="white"/>',
+           '<text x="{}" y="22" text-anchor="middle" font-size="14" font-weight="bold">'
+           'RedReactor Battery Monitor Status</text>'.format(WIDTH // 2)]
+
+    # Main plot for voltage and current
+    svg += _y_axis(2.4, 4.3, 5, MAIN, 'black')
+    svg += _y_axis(y_min, y_max, 5, MAIN, 'blue', right_side=True, grid=False)
+    svg += _x_axis(samples, MAIN)
+    svg.append(_polyline(x1, y1, samples, 2.4, 4.3, MAIN, 'red'))
+    svg.append(_polyline(x2, y2, samples, y_min, y_max, MAIN, 'blue'))
+    svg.append('<text x="14" y="195" transform="rotate(-90 14 195)" text-anchor="middle">Voltage (V)</text>')
+    svg.append('<text x="488" y="195" transform="rotate(90 488 195)" text-anchor="middle" fill="blue">'
+               'Current (mA)</text>')
+    svg.append('<text x="70" y="325" fill="red">&#8212; Volts (V)</text>')
+    svg.append('<text x="70" y="340" fill="blue">&#8212; Current (mA)</text>')
+
+    # Temperature plot
+    svg += _y_axis(0, 100, 4, TEMP, 'red')
+    svg += _y_axis(0, 100, 4, TEMP, 'red', right_side=True, grid=False)
+    svg += _x_axis(samples, TEMP)
+    svg.append(_polyline(x3, t1, samples, 0, 100, TEMP, 'orange'))
+    svg.append('<text x="14" y="485" transform="rotate(-90 14 485)" text-anchor="middle" fill="orange">'
+               'Temp (degrees)</text>')
+    svg.append('<text x="70" y="435" fill="orange">&#8212; Temp (C)</text>')
+    svg.append('</svg>')
+
+    with open(file_name, 'w') as svg_file:
+        svg_file.write("\n".join(svg))
+
+
+# Test rr_plots_svg function
+if __name__ == "__main__":
+    print("RR_PlotSVG : Testing plot function with example data")
+
+    # Lengths should be the same
+    history_volts = [4.2, 4.1, 4.0, 3.9, 3.8, 3.7, 3.6, 3.5, 3.4, 3.3,
+                     3.2, 3.2, 3.1, 3.0, 2.9, 3.2, 3.5, 4.0, 4.2]
+    history_milli = [1.0, 1400, 1200, 1500, 1800, 1250, 1000, 900, 600, 500,
+                     500, 800, 900, 800, 1700, -1000, -400, -250, 2]
+    history_temp = [33.5, 38, 45, 50, 55.5, 60, 63.2, 68.9, 74, 65.1,
+                    55.9, 52, 65, 69, 78, 61.9, 45, 40, 38]
+
+    RR_Downsample.use_numpy = False
+    rr_plots_svg(history_volts, history_milli, history_temp)
@@ -11,6 +11,7 @@
 
 # Input is lists of Y1 (Volts), Y2 (mA), Temp : length defines number of samples
 # Min-max are fixed based on the RedReactor specifications
+# Long histories are downsampled to RR_Downsample.PLOT_POINTS (LTTB for volts/temp, min/max for current peaks)
 
 *** You may use/modify only for use with the RED REACTOR product
 *** Filename: RR_Plotgraphs.py
@@ -19,11 +20,8 @@
 """
 
 # Import Libraries
-import numpy as np
-# Use 'Agg' (non-gui) to remove thread warning
-import matplotlib
-import matplotlib.pyplot as plt
-matplotlib.use('Agg')
+# numpy and matplotlib are imported by rr_plots on first use, saving start-up time and memory
+import RR_Downsample
 
 # Only show plot if used stand-alone
 show_plot = False
@@ -39,11 +37,20 @@ def rr_plots(y1: list, y2: list, temperature: list):
     All lists assumed to be the same length (= number of samples)
     """
 
+    import numpy as np
+    # Use 'Agg' (non-gui) to remove thread warning
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     print("RR_Plotgraphs : Plotting samples:", len(y1))
     x1data = np.arange(len(y1))
-    y1data = np.array(y1)
-    y2data = np.array(y2)
-    t1data = np.array(temperature)
+    # Reduce to the pixel budget, keeping the shape of each line
+    x1plot, y1data = RR_Downsample.downsample(y1, RR_Downsample.PLOT_POINTS, 'lttb')
+    x2plot, y2data = RR_Downsample.downsample(y2, RR_Downsample.PLOT_POINTS, 'minmax')
+    t1plot, t1data = RR_Downsample.downsample(temperature, RR_Downsample.PLOT_POINTS, 'lttb')
+    # Markers only for short histories, else just the line
+    style = '-o' if len(y1) <= 100 else '-'
 
     # Create Plot space
     fig, (ax1, ax3) = plt.subplots(nrows=2, ncols=1, gridspec_kw={'height_ratios': [2, 1]})
@@ -55,7 +62,7 @@ def rr_plots(y1: list, y2: list, temperature: list):
     ax1.set_xlabel('Time (samples)')
     ax1.set_ylabel('Voltage (V)', color='black')
     # -o to plot marker and line
-    line1 = ax1.plot(x1data, y1data, '-o', color='red', label='Volts (V)')
+    line1 = ax1.plot(x1plot, y1data, style, color='red', label='Volts (V)')
 
     ax1.tick_params(axis='y', labelcolor='black')
 
@@ -63,7 +70,7 @@ def rr_plots(y1: list, y2: list, temperature: list):
     ax2 = ax1.twinx()
     ax2.set_ylabel('Current (mA)', color='blue')
     # -o to plot marker and line
-    line2 = ax2.plot(x1data, y2data, '-o', color='blue', label='Current (mA)')
+    line2 = ax2.plot(x2plot, y2data, style, color='blue', label='Current (mA)')
     ax2.tick_params(axis='y', labelcolor='blue')
 
     # Set x-axis tick interval to scale with dataset
@@ -92,7 +99,7 @@ def rr_plots(y1: list, y2: list, temperature: list):
     ax3.set_xlabel('Time (samples)')
     ax3.set_ylabel('Temp (degrees)', color='orange')
     # -o to plot marker and line
-    ax3.plot(x1data, t1data, '-o', color='orange', label='Temp (C)')
+    ax3.plot(t1plot, t1data, style, color='orange', label='Temp (C)')
 
     # Set x-axis tick interval
     ax3.set_xticks(np.arange(min(x1data), max(x1data) + int(max(x1data)/10)+1,
@@ -123,8 +130,6 @@ if __name__ == "__main__":
     print("RR_Plotgraphs : Testing plot function with example data")
     show_plot = True
 
-    x = np.arange(0, 15, 0.2)
-
     # Lengths should be the same
     history_volts = [4.2, 4.1, 4.0, 3.9, 3.8, 3.7, 3.6, 3.5, 3.4, 3.3,
                      3.2, 3.2, 3.1, 3.0, 2.9, 3.2, 3.5, 4.0, 4.2]
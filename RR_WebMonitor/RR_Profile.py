@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Measures RR_WebMonitor start-up time and peak memory in normal (matplotlib) and lite (SVG) modes
+
+# Each mode runs in a fresh python process: imports the web server and graph modules,
+# then draws one graph of the given number of samples (default 100)
+# Usage: python3 RR_Profile.py [samples]
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Profile.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import subprocess
+import sys
+import tempfile
+from json import loads
+from os import path
+
+# Runs inside the child process, prints json results
+PROFILE_CODE = """
+import json, math, resource, sys, time
+start = time.perf_counter()
+sys.path.insert(0, {folder!r})
+import flask
+import RR_Downsample
+import RR_History
+if {lite}:
+    import RR_PlotSVG
+    RR_Downsample.use_numpy = False
+    rr_plots = RR_PlotSVG.rr_plots_svg
+else:
+    import RR_Plotgraphs
+    rr_plots = RR_Plotgraphs.rr_plots
+imported = time.perf_counter()
+
+volts = [3.7 + 0.3 * math.sin(i / 20) for i in range({samples})]
+current = [800 + 400 * math.sin(i / 7) for i in range({samples})]
+temperature = [45 + 10 * math.sin(i / 30) for i in range({samples})]
+rr_plots(volts, current, temperature)
+first = time.perf_counter()
+rr_plots(volts, current, temperature)
+second = time.perf_counter()
+
+print(json.dumps({{'import': imported - start, 'first': first - imported, 'next': second - first,
+                  'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}}))
+"""
+
+
+def profile(lite, samples):
+    """Returns timings (s) and peak RSS (kB) for one mode, run in a temporary directory"""
+    folder = path.dirname(path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = subprocess.run([sys.executable, "-c", PROFILE_CODE.format(folder=folder, lite=lite,
+                                                                           samples=samples)],
+                                cwd=work_dir, stdout=subprocess.PIPE, check=True)
+    return loads(result.stdout.decode().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    test_samples = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+
+    print("RR_Profile : {} samples".format(test_samples))
+    print("Mode    Imports(s)  First graph(s)  Next graph(s)  Peak RSS(MB)")
+    for mode, lite_mode in (("normal", False), ("lite", True)):
+        try:
+            stats = profile(lite_mode, test_samples)
+        except subprocess.CalledProcessError:
+            print("{:8}failed, check the required libraries are installed".format(mode))
+            continue
+        print("{:8}{:10.3f}  {:14.3f}  {:13.3f}  {:12.1f}".format(mode, stats['import'], stats['first'],
+                                                                  stats['next'], stats['rss'] / 1024))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Latest battery sample in a small memory mapped file, for scripts, widgets and the rr command
+
+# The sampler (RR_WebMonitor) writes each sample with StatusWriter.publish()
+# Readers map the file once, StatusReader.read() then returns a consistent snapshot without any system calls
+# A sequence number is odd while a sample is being written, readers retry if it was odd or changed (seqlock)
+# File: $RR_STATUS_FILE, else /run/redreactor/status (RuntimeDirectory in the service file), else /dev/shm
+# From the shell: python3 RR_Status.py
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Status.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import math
+import mmap
+import os
+import struct
+import time
+
+STATUS_FILES = ("/run/redreactor/status", "/dev/shm/redreactor-status")
+
+# Fixed little-endian layout, change LAYOUT if the record changes
+MAGIC = b"RRST"
+LAYOUT = 1
+# magic, layout, sequence
+HEADER = struct.Struct("<4sII")
+SEQUENCE_OFFSET = 8
+# time, sample, voltage, current (mA), charge %, status, flags, cpu temperature, up time, battery time, writer pid
+RECORD = struct.Struct("<dIffBBBxfIII")
+FILE_SIZE = 64
+
+STATUS_NAMES = ("FULL", "CHARGING", "DISCHARGING", "FAULT")
+UNKNOWN = 255
+FLAG_SHUTDOWN = 1
+
+# Readers retry a torn read, yielding to the writer after the first few attempts (it takes microseconds)
+READ_SPINS = 10
+READ_RETRIES = 10000
+
+
+def status_file():
+    """Returns the status file name in use, or to be used by the writer"""
+    if os.environ.get('RR_STATUS_FILE'):
+        return os.environ['RR_STATUS_FILE']
+    for file_name in STATUS_FILES:
+        if os.path.exists(file_name):
+            return file_name
+    for file_name in STATUS_FILES:
+        if os.access(os.path.dirname(file_name), os.W_OK):
+            return file_name
+    return STATUS_FILES[0]
+
+
+class StatusWriter:
+    """Publishes each sample into the status file, used by one sampler process"""
+
+    def __init__(self, file_name=None):
+        self.file_name = file_name or status_file()
+        self.pid = os.getpid()
+        self.sequence = 0
+        # Re-use an existing file (never unlink it), so readers keep a valid mapping across restarts
+        status_fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(status_fd).st_size != FILE_SIZE:
+                os.ftruncate(status_fd, FILE_SIZE)
+            self.map = mmap.mmap(status_fd, FILE_SIZE)
+        finally:
+            os.close(status_fd)
+        magic, layout, sequence = HEADER.unpack_from(self.map)
+        if magic == MAGIC and layout == LAYOUT:
+            # Continue the sequence, rounded up to even in case the last writer died mid-sample
+            self.sequence = sequence + (sequence & 1)
+        HEADER.pack_into(self.map, 0, MAGIC, LAYOUT, self.sequence)
+
+    def publish(self, sample, voltage, current, charge, status, cpu_temp=None, up_time=0, battery_time=0,
+                shutdown=False, sample_time=None):
+        self.sequence += 1
+        struct.pack_into("<I", self.map, SEQUENCE_OFFSET, self.sequence)
+        RECORD.pack_into(self.map, HEADER.size,
+                         time.time() if sample_time is None else sample_time,
+                         sample & 0xFFFFFFFF,
+                         voltage,
+                         current,
+                         max(0, min(100, int(charge))),
+                         STATUS_NAMES.index(status) if status in STATUS_NAMES else UNKNOWN,
+                         FLAG_SHUTDOWN if shutdown else 0,
+                         math.nan if cpu_temp is None else cpu_temp,
+                         int(up_time),
+                         int(battery_time),
+                         self.pid)
+        self.sequence += 1
+        struct.pack_into("<I", self.map, SEQUENCE_OFFSET, self.sequence)
+
+    def close(self):
+        self.map.close()
+
+
+class StatusReader:
+    """Maps the status file read-only, read() returns the latest sample as a dict (None if not written yet)"""
+
+    def __init__(self, file_name=None):
+        self.file_name = file_name or status_file()
+        # Raises OSError if the sampler hasn't created the file
+        with open(self.file_name, 'rb') as status:
+            self.map = mmap.mmap(status.fileno(), FILE_SIZE, access=mmap.ACCESS_READ)
+
+    def read(self):
+        for attempt in range(READ_RETRIES):
+            magic, layout, before = HEADER.unpack_from(self.map)
+            if not before & 1:
+                record = RECORD.unpack_from(self.map, HEADER.size)
+                if HEADER.unpack_from(self.map)[2] == before:
+                    break
+            if attempt >= READ_SPINS:
+                time.sleep(0)
+        else:
+            raise RuntimeError("RR_Status : sample kept changing during read")
+        if magic != MAGIC or layout != LAYOUT:
+            raise RuntimeError("RR_Status : {} is not a layout {} status file".format(self.file_name, LAYOUT))
+        if before == 0:
+            return None
+        sample_time, sample, voltage, current, charge, status, flags, cpu_temp, up_time, battery_time, pid = record
+        return {'Time': sample_time,
+                'Age': time.time() - sample_time,
+                'Sample': sample,
+                'Voltage': voltage,
+                'Current': current,
+                'Power': voltage * current / 1000,
+                'Charge': charge,
+                'Status': STATUS_NAMES[status] if status < len(STATUS_NAMES) else "UNKNOWN",
+                'Shutdown': bool(flags & FLAG_SHUTDOWN),
+                'CPU_Temp': None if math.isnan(cpu_temp) else cpu_temp,
+                'Up_Time': up_time,
+                'Bat_Time': battery_time,
+                'PID': pid}
+
+    def close(self):
+        self.map.close()
+
+
+# Show the latest sample, and the cost of reading it
+if __name__ == "__main__":
+    import sys
+    import timeit
+
+    try:
+        reader = StatusReader(sys.argv[1] if len(sys.argv) > 1 else None)
+    except OSError as error:
+        print("RR_Status : No status file, is RR_WebMonitor running?\nError:", error)
+        sys.exit(1)
+    latest = reader.read()
+    if latest is None:
+        print("RR_Status : No sample yet")
+    else:
+        for key, value in latest.items():
+            print("{:10}: {}".format(key, round(value, 3) if isinstance(value, float) else value))
+    runs = 100000
+    print("RR_Status : {:.2f}us per read".format(timeit.timeit(reader.read, number=runs) / runs * 1e6))
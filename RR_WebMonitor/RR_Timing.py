@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Lightweight timers, counters and fixed-bucket histograms to see where the time goes
+
+# Wrap a stage:    with timings.stage('i2c_read'):
+# Count an event:  timings.count('i2c_error')
+# Fixed rate loop: ticker = Ticker(5, 'sample') then call ticker.wait() after the work of each tick
+# Each stage costs about a microsecond, so it can be left on in production
+# Dump on demand with: kill -USR1 <pid> (after timings.dump_on_signal()), or use report()/snapshot()
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_Timing.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import bisect
+import signal
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds, from an I2C read (~1ms) to SMTP/graph drawing (seconds)
+BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0, 10.0)
+
+# Longest sleep before a Ticker checks for a stop request
+STOP_POLL = 1.0
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations, the last bucket counts everything above BUCKETS[-1]"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.last = 0.0
+
+    def observe(self, seconds):
+        self.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.last = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples, limited to the max seen"""
+        target = fraction * self.count
+        total = 0
+        for index, bucket in enumerate(self.buckets):
+            total += bucket
+            if total >= target and total:
+                return min(BUCKETS[index], self.max) if index < len(BUCKETS) else self.max
+        return 0.0
+
+
+class _Stage:
+    # Context manager for one timed run of a stage
+    __slots__ = ('timings', 'name', 'start')
+
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.timings.observe(self.name, time.perf_counter() - self.start)
+        if exc_type is not None:
+            self.timings.count(self.name + "_error")
+        return False
+
+
+class Timings:
+    """Named stage histograms and event counters, shared by all threads of an application"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+        self.counters = {}
+        self.started = time.monotonic()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def observe(self, name, seconds):
+        with self.lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, increment=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + increment
+
+    def get(self, name):
+        """Returns the stage histogram, or an empty one if not run yet"""
+        return self.stages.get(name, Histogram())
+
+    def snapshot(self):
+        """Returns dict of stage statistics (seconds) and counters, e.g. for JSON"""
+        with self.lock:
+            stages = {name: {'count': hist.count,
+                             'mean': hist.sum / hist.count if hist.count else 0.0,
+                             'last': hist.last,
+                             'p50': hist.quantile(0.5),
+                             'p95': hist.quantile(0.95),
+                             'max': hist.max,
+                             'buckets': list(hist.buckets)} for name, hist in self.stages.items()}
+            return {'uptime': time.monotonic() - self.started,
+                    'stages': stages,
+                    'counters': dict(self.counters)}
+
+    def report(self):
+        """Returns a text table of all stages and counters"""
+        snapshot = self.snapshot()
+        lines = ["Timings over {:.0f}s (ms)".format(snapshot['uptime']),
+                 "{:20} {:>8} {:>9} {:>9} {:>9} {:>9}".format("Stage", "Count", "Mean", "p50<=", "p95<=", "Max")]
+        for name, stage in sorted(snapshot['stages'].items()):
+            lines.append("{:20} {:8} {:9.3f} {:9.3f} {:9.3f} {:9.3f}".format(name, stage['count'],
+                                                                             stage['mean'] * 1000,
+                                                                             stage['p50'] * 1000,
+                                                                             stage['p95'] * 1000,
+                                                                             stage['max'] * 1000))
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append("{:20} {:8}".format(name, value))
+        return "\n".join(lines)
+
+    def dump_on_signal(self, output=print, signum=None):
+        """Writes report() to output (e.g. print or logger.info) on SIGUSR1, call from the main thread"""
+        signal.signal(signal.SIGUSR1 if signum is None else signum, lambda sig, frame: output(self.report()))
+
+
+# Shared timings for all users within the application
+timings = Timings()
+
+
+class Ticker:
+    """Runs a loop on absolute monotonic deadlines, so the period does not drift by the work time
+    Records the lateness of every tick as stage name + "_lateness", and whole periods missed as name + "_skipped"
+    """
+
+    def __init__(self, period, name='tick', stats=None):
+        self.period = period
+        self.name = name
+        self.timings = timings if stats is None else stats
+        self.deadline = time.monotonic()
+        self.skipped = 0
+
+    def wait(self, stop=None):
+        """Sleeps until the next deadline, checking stop() every STOP_POLL seconds
+        Returns the number of periods since the last tick (more than 1 if ticks were skipped), or 0 if stopped
+        """
+        self.deadline += self.period
+        while True:
+            delay = self.deadline - time.monotonic()
+            if delay <= 0:
+                break
+            if stop is not None:
+                if stop():
+                    return 0
+                delay = min(delay, STOP_POLL)
+            time.sleep(delay)
+        return self.tick(advance=False)
+
+    def tick(self, advance=True):
+        """Records this tick against the schedule, for loops timed elsewhere (e.g. a QTimer)"""
+        if advance:
+            self.deadline += self.period
+        late = time.monotonic() - self.deadline
+        missed = int(late // self.period) if late >= self.period else 0
+        if missed:
+            # Overran by whole periods, keep to the schedule rather than catching up
+            self.skipped += missed
+            self.timings.count(self.name + "_skipped", missed)
+            self.deadline += missed * self.period
+            late -= missed * self.period
+        self.timings.observe(self.name + "_lateness", late)
+        return missed + 1
+
+    def reset(self):
+        """Restarts the schedule from now, e.g. after a pause"""
+        self.deadline = time.monotonic()
+
+
+# Test overhead of a timed stage
+if __name__ == "__main__":
+    runs = 100000
+    start = time.perf_counter()
+    for run in range(runs):
+        with timings.stage('empty'):
+            pass
+    print("RR_Timing : {:.2f}us per stage".format((time.perf_counter() - start) / runs * 1e6))
+    for delay in (0.001, 0.003, 0.02):
+        with timings.stage('sleep'):
+            time.sleep(delay)
+    timings.count('example')
+    ticker = Ticker(0.05, 'example')
+    for run in range(10):
+        # Every 4th tick overruns by more than a period
+        time.sleep(0.12 if run % 4 == 3 else 0.01)
+        ticker.wait()
+    print(timings.report())
@@ -83,6 +83,11 @@ class RRWebBat:
         # [FULL, CHARGING, DISCHARGING, FAULT]
         self.battery_status = "FULL"
 
+        # Counters for /metrics: I2C read failures, current out of range, charges completed (since start)
+        self.i2c_errors = 0
+        self.range_errors = 0
+        self.charge_cycles = 0
+
         # Initialise history of 4 readings, last element is most recent
         self.history = [self.voltage, self.voltage, self.voltage, self.voltage]
 
@@ -98,15 +103,31 @@ class RRWebBat:
         Simple function to track battery status
         """
 
-        # Wake up INA219 IC
-        self.ina.wake()
-
-        # This is the sum of the bus voltage and shunt voltage
-        self.voltage = self.ina.voltage()
+        range_error = None
         try:
-            # Returns the bus current in milliamps (mA), or exception if exceed limit
-            # Value is positive for discharge, negative for charging, or <10 if FULL and charger connected
-            self.current = self.ina.current()
+            # Wake up INA219 IC
+            self.ina.wake()
+            try:
+                # This is the sum of the bus voltage and shunt voltage
+                voltage = self.ina.voltage()
+                # Returns the bus current in milliamps (mA), or exception if exceed limit
+                # Value is positive for discharge, negative for charging, or <10 if FULL and charger connected
+                try:
+                    current = self.ina.current()
+                except DeviceRangeError as e:
+                    range_error = e
+            finally:
+                # Put INA219 IC device to sleep until next read request, also after a failed read
+                self.ina.sleep()
+        except OSError as e:
+            # I2C bus error, keep the last reading (voltage and status together) and try again next time
+            print("RED REACTOR : I2C read error\nError:", e)
+            self.i2c_errors += 1
+            return
+        self.voltage = voltage
+        last_status = self.battery_status
+        if range_error is None:
+            self.current = current
             if self.current < 0:
                 self.battery_status = "CHARGING"
             elif self.current < 10:
@@ -121,15 +142,19 @@ class RRWebBat:
                     self.battery_status = "FULL"
             else:
                 self.battery_status = "DISCHARGING"
-
-        except DeviceRangeError as e:
+        else:
             # Current out of device range with specified shunt resistor
-            print("RED REACTOR : Current Load out of measurement range\nError:", e)
+            print("RED REACTOR : Current Load out of measurement range\nError:", range_error)
+            self.range_errors += 1
             # Max shunt voltage is 0.32v but at 0.05 Ohms this would be 6.4 Amps
             self.current = 6400.0
             self.battery_status = "FAULT"
             self.battery_charge = 100
 
+        # Count a charge cycle each time charging completes
+        if last_status == "CHARGING" and self.battery_status == "FULL":
+            self.charge_cycles += 1
+
         # Update read history, maintains last 4 readings incl. this one
         self.history.pop(0)
         self.history.append(self.voltage)
@@ -158,9 +183,6 @@ class RRWebBat:
             print("RED REACTOR : LOW battery voltage warning")
             self.shutdown = True
 
-        # Put INA219 IC device to sleep until next read request
-        self.ina.sleep()
-
 
 # Test code for running stand-alone and shows usage of functions
 if __name__ == "__main__":
@@ -20,28 +20,77 @@
 *** Date: April 2022
 """
 
-# Import battery monitoring class to run as background thread
-# Added check that Red Reactor can be read from
-try:
-    import RR_WebBat
-    rr_status_ok = True
-except RuntimeError:
-    print("ERROR: Unable to access I2C, limiting functionality")
-    rr_status_ok = False
-
-import RR_Plotgraphs
+import RR_Downsample
+import RR_History
+import RR_LogSink
+import RR_Metrics
+import RR_Status
+from RR_SysHealth import health, throttled_text
+from RR_Timing import timings, Ticker, BUCKETS
+from RR_I2CLock import i2c_lock
 
 import time
 import threading
 import subprocess
-from os import path
-from datetime import timedelta
-from gpiozero import CPUTemperature
+import signal
+import sqlite3
+import gzip
+from os import path, environ
+from datetime import datetime, timedelta, timezone
+from json import dumps
+
+from flask import Flask, Response, jsonify, render_template, request, send_from_directory
+from werkzeug.http import is_resource_modified
+
+# Deployment mode, set RR_WEB_MODE in the environment (or the service files)
+# standalone : one process samples the battery and runs the Flask server (default)
+# sampler    : only process to access the Red Reactor, write the log/history and watch for shutdown
+#              serves the workers on the RR_WEB_SOCKET Unix socket
+# worker     : web server only (e.g. several gunicorn workers behind nginx), reads all data from the sampler
+WEB_MODE = environ.get('RR_WEB_MODE', 'standalone')
 
-from flask import Flask, render_template, request, send_from_directory
+# Import battery monitoring class to run as background thread
+# Added check that Red Reactor can be read from
+if WEB_MODE == 'worker':
+    # Workers never access I2C, the sampler reports the Red Reactor status
+    rr_status_ok = True
+else:
+    try:
+        import RR_WebBat
+        rr_status_ok = True
+    except RuntimeError:
+        print("ERROR: Unable to access I2C, limiting functionality")
+        rr_status_ok = False
+
+if WEB_MODE != 'standalone':
+    # Sampler to worker connection
+    import RR_WebShared
+    WEB_SOCKET = environ.get('RR_WEB_SOCKET', RR_WebShared.SOCKET_FILE)
 
 app = Flask(__name__)
-cpu = CPUTemperature()
+
+# Battery sample period (seconds), the log and graph use the user defined interval
+SAMPLE_PERIOD = 5
+
+# History is kept in memory and downsampled for display, e.g. 6 days at 30s intervals
+MAX_HISTORY = 17280
+
+# Lite mode draws the graph as SVG without numpy/matplotlib, for e.g. the Pi Zero
+# Set RR_WEB_LITE=1 in the environment (or the RR_WebMonitor.service file) to enable
+LITE_MODE = environ.get('RR_WEB_LITE', '0') == '1'
+if LITE_MODE:
+    import RR_PlotSVG
+    RR_Downsample.use_numpy = False
+    rr_plots = RR_PlotSVG.rr_plots_svg
+    GRAPH_FILE = 'RR_Status.svg'
+else:
+    import RR_Plotgraphs
+    rr_plots = RR_Plotgraphs.rr_plots
+    GRAPH_FILE = 'RR_Status.png'
+
+# Responses compressed when the browser accepts gzip (PNG is already compressed)
+GZIP_TYPES = ('text/html', 'application/json', 'image/svg+xml')
+GZIP_MIN_SIZE = 500
 
 
 # Create Monitor Function
@@ -64,18 +113,43 @@ class WebStats:
         self.op_status = "Initialising"
         self.stop = False
 
+        # Live updates: sample_count increments on every battery sample, form_count on every
+        # form/graph update. Stream clients wait on sample_ready instead of polling
+        # Both restart at 0 with the process, so page versions (ETags) also include its start time
+        self.boot_id = "{:x}".format(int(time.time() * 1000))
+        self.sample_count = 0
+        self.sample_time = time.time()
+        self.form_count = 0
+        self.last_form = 0
+        self.viewers = 0
+        self.sample_ready = threading.Condition()
+        self.form_lock = threading.Lock()
+
+        # /metrics page for the latest sample
+        self.metrics = b""
+
+        # Latest sample in a memory mapped file, for rr and other local readers
+        try:
+            self.status_file = RR_Status.StatusWriter()
+        except OSError as error:
+            print("RR_WebMonitor Status file Error:", error)
+            self.status_file = None
+
         self.readings = 0
         self.history_volts = list()
         self.history_current = list()
         self.history_temp = list()
 
-        # Open Logfile (but don't write until asked)
-        self.log_file = open("RR_WebMonitor.log", 'a')
+        # Open Logfile (but don't write until asked), buffered and rotated to spare the SD card
+        self.log_file = RR_LogSink.LogSink("RR_WebMonitor.log")
         if self.log_data:
             self.log_file.write("*" * 50 +
                                 "\nAppending New Log Data on {}\n".format(time.asctime()) +
                                 "*" * 50 + "\n")
 
+        # Long term history of every sample, with 1 minute, 1 hour and 1 day rollups
+        self.store = RR_History.RRHistory("RR_History.db")
+
         # Initialise RedReactor
         self.battery = RR_WebBat.RRWebBat()
 
@@ -84,7 +158,7 @@ class WebStats:
         if self.interval != interval and 5 <= interval <= 60:
             self.interval = int(interval)
 
-        if self.history != history and 10 <= history <= 100:
+        if self.history != history and 10 <= history <= MAX_HISTORY:
             self.history = int(history)
 
         if self.averaging != averaging and 1 <= averaging <= 10:
@@ -103,16 +177,36 @@ class WebStats:
 
     def update_bat_status(self):
         # Run as independent thread of web-form activity so can shutdown if necessary
+        # Samples are taken every SAMPLE_PERIOD seconds, however long the work below takes
+        ticker = Ticker(SAMPLE_PERIOD, 'sample')
         while not self.stop:
             # Continuously update battery status
-            self.battery.get_battery()
+            # Other Red Reactor monitors mustn't sleep the device during the read
+            with i2c_lock, timings.stage('i2c_read'):
+                self.battery.get_battery()
+            with timings.stage('history_store'):
+                self.store_sample()
+
+            # Keep graph history going whilst a browser is watching the live stream
+            if self.viewers:
+                self.update_form_data(False)
+
+            # Push new sample to any waiting stream clients
+            self.notify_sample()
+            if self.status_file is not None:
+                with timings.stage('status_publish'):
+                    self.status_file.publish(self.sample_count, self.battery.voltage, self.battery.current,
+                                             self.battery.battery_charge, self.battery.battery_status,
+                                             health.read()[0], self.up_time, self.battery_time,
+                                             self.battery.shutdown, self.sample_time)
+            with timings.stage('metrics_encode'):
+                self.encode_metrics()
+            with timings.stage('log_flush'):
+                self.log_file.flush_if_due()
 
             if not self.battery.shutdown:
                 # Enable early exit on stop request
-                sleep_time = 0
-                while sleep_time < 5 and not self.stop:
-                    time.sleep(1)
-                    sleep_time += 1
+                sleep_time = ticker.wait(lambda: self.stop) * SAMPLE_PERIOD
                 self.up_time += sleep_time
                 if self.battery.battery_status == 'DISCHARGING':
                     self.battery_time += sleep_time
@@ -124,16 +218,189 @@ class WebStats:
                 # Will force a shutdown after clean exit delay
                 subprocess.Popen(['sleep 5;sudo shutdown -h now'], shell=True)
                 self.log_file.close()
+                self.store.close()
                 exit(1)
         # exit due to user stop request
         self.log_file.close()
+        self.store.close()
+
+    def store_sample(self):
+        # Add latest sample to the long term history, carry on if the database fails
+        try:
+            temperature = health.read()[0]
+            self.store.add(time.time(), self.battery.voltage, self.battery.current,
+                           temperature or 0.0, self.battery.battery_status)
+        except sqlite3.Error as error:
+            print("RR_WebMonitor History Error:", error)
+
+    def metrics_data(self):
+        return self.metrics
 
     def finish(self):
         self.stop = True
-
-    def update_form_data(self):
-        # Gather data for web-form update [keep up to 100 records, only show required history]
-        if self.readings >= 100:
+        self.notify_sample()
+
+    def notify_sample(self):
+        # Wake up all stream clients waiting for a new sample
+        with self.sample_ready:
+            self.sample_count += 1
+            self.sample_time = time.time()
+            self.sample_ready.notify_all()
+
+    def wait_sample(self, last_sample, timeout):
+        # Blocks (at no cost) until a sample newer than last_sample is available, or timeout
+        with self.sample_ready:
+            self.sample_ready.wait_for(lambda: self.sample_count != last_sample or self.stop, timeout)
+            return self.sample_count
+
+    def add_viewer(self, count):
+        with self.sample_ready:
+            self.viewers += count
+
+    def power_text(self):
+        # External power description for the web-form
+        if self.battery.battery_status == "CHARGING":
+            return "Yes, Charging at {}%".format(self.battery.battery_charge)
+        elif self.battery.battery_status == "FULL":
+            return "Yes, Battery FULL"
+        elif self.battery.battery_status == "DISCHARGING":
+            return "No, Battery at {}%".format(self.battery.battery_charge)
+        else:
+            return "BATTERY FAULT!!"
+
+    def live_data(self):
+        # Latest battery sample, as pushed to the live stream
+        colour, warning = battery_colour(self.battery.battery_status, self.battery.battery_charge)
+        return {'Boot': self.boot_id,
+                'Sample': self.sample_count,
+                'Form': self.form_count,
+                'Time': self.sample_time,
+                'Last_Volts': "{:.3f}".format(self.battery.voltage),
+                'Last_Current': "{:.2f}".format(self.battery.current),
+                'Bat_Status': self.battery.battery_status,
+                'Bat_Charge': self.battery.battery_charge,
+                'Bat_Colour': colour,
+                'Ext_Power': self.power_text(),
+                'Ext_Warning': warning,
+                'Shutdown': self.battery.shutdown
+                }
+
+    def encode_metrics(self):
+        # Prometheus page for the latest sample, so a scrape never touches the I2C bus
+        battery = self.battery
+        metric = RR_Metrics.metric
+        families = [
+            metric('rr_battery_voltage_volts', 'gauge', "Battery voltage", battery.voltage),
+            metric('rr_battery_current_amps', 'gauge', "Battery current, negative when charging",
+                   battery.current / 1000),
+            metric('rr_battery_power_watts', 'gauge', "Battery power, negative when charging",
+                   battery.voltage * battery.current / 1000),
+            metric('rr_battery_charge_percent', 'gauge', "Battery state of charge", battery.battery_charge),
+            metric('rr_battery_status', 'gauge', "Battery status (1 = current status)",
+                   {status: status == battery.battery_status for status in RR_History.STATUS}, 'status'),
+            metric('rr_battery_shutdown', 'gauge', "Low battery shutdown required", battery.shutdown),
+            metric('rr_charge_cycles_total', 'counter', "Charges completed since start", battery.charge_cycles),
+            metric('rr_i2c_errors_total', 'counter', "Red Reactor I2C read errors", battery.i2c_errors),
+            metric('rr_current_range_errors_total', 'counter', "Current out of measurement range",
+                   battery.range_errors),
+            metric('rr_samples_total', 'counter', "Battery samples taken", self.sample_count),
+            metric('rr_sample_timestamp_seconds', 'gauge', "Time of the latest sample", self.sample_time),
+            metric('rr_sample_duration_seconds', 'summary', "Time to read the Red Reactor",
+                   (timings.get('i2c_read').sum, timings.get('i2c_read').count)),
+            metric('rr_graph_render_seconds', 'summary', "Time to draw the status graph",
+                   (timings.get('render').sum, timings.get('render').count)),
+            metric('rr_form_updates_total', 'counter', "Web-form and graph updates", self.form_count),
+            metric('rr_stream_viewers', 'gauge', "Browsers connected to the live stream", self.viewers),
+            metric('rr_uptime_seconds', 'gauge', "System up time", self.up_time)
+        ]
+        temperature = health.read()[0]
+        if temperature is not None:
+            families.append(metric('rr_cpu_temperature_celsius', 'gauge', "CPU temperature", temperature))
+        # Time taken by each monitor stage (RR_Timing)
+        with timings.lock:
+            families.append(RR_Metrics.histograms('rr_stage_seconds', "Monitor stage durations",
+                                                  dict(timings.stages), BUCKETS))
+            families.append(metric('rr_stage_events_total', 'counter', "Monitor stage events and errors",
+                                   dict(timings.counters), 'event'))
+        self.metrics = RR_Metrics.encode(families)
+
+    def form_data(self):
+        # Collects all web-form values from the last form update
+        colour, warning = battery_colour(self.battery.battery_status, self.battery.battery_charge)
+        return {'Interval': self.interval,
+                'History': self.history,
+                'Averaging': self.averaging,
+                'Log_Data': "1" if self.log_data else "0",
+                'Last_Volts': "{:.3f}".format(self.battery.voltage),
+                'Last_Current': "{:.2f}".format(self.battery.current),
+                'Average_Volts': "{:.3f}".format(self.average_volts),
+                'Average_Current': "{:.2f}".format(self.average_current),
+                'Op_Status': "{}".format(self.op_status),
+                'Bat_Charge': self.battery.battery_charge,
+                'Bat_Colour': colour,
+                'Ext_Power': self.ext_power,
+                'Ext_Warning': warning,
+                'Temperature': self.temperature,
+                'Up_Time': "hrs:".join(str(timedelta(seconds=self.up_time)).split(":")[:-1]),
+                'Bat_Time': time.strftime("%Hhrs:%Mmins", time.gmtime(self.battery_time)),
+                'Time_Now': time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime()),
+                'Boot': self.boot_id,
+                'Form': self.form_count,
+                'Sample': self.sample_count,
+                'Time': self.sample_time,
+                'Max_History': MAX_HISTORY,
+                'Graph': GRAPH_FILE
+                }
+
+    def history_data(self, points, history=None, since=None, until=None, method='lttb'):
+        # JSON history, from the long term store if since is given, else the graph history
+        if since is not None:
+            try:
+                data = self.store.query(since, until)
+                # Not the sum of the rollups, as the first and last buckets can extend beyond the range
+                energy = self.store.energy(since, until)
+            except sqlite3.Error as error:
+                return {'Error': str(error)}
+            volts, current, temperature = data['volts'], data['current'], data['temp']
+            times = data['ts']
+        else:
+            history = self.history if history is None else history
+            with self.form_lock:
+                volts = self.history_volts[-history:]
+                current = self.history_current[-history:]
+                temperature = self.history_temp[-history:]
+            # Index 0 is the oldest sample of the requested range
+            times = list(range(len(volts)))
+        samples = len(volts)
+
+        volts_x, volts = RR_Downsample.downsample(volts, points, method)
+        current_x, current = RR_Downsample.downsample(current, points, method)
+        temp_x, temperature = RR_Downsample.downsample(temperature, points, method)
+        result = {'Interval': self.interval,
+                  'Samples': samples,
+                  'Volts': {'x': [times[i] for i in volts_x], 'y': volts},
+                  'Current': {'x': [times[i] for i in current_x], 'y': current},
+                  'Temperature': {'x': [times[i] for i in temp_x], 'y': temperature}
+                  }
+        if since is not None:
+            result['Resolution'] = data['res']
+            result['Energy_Wh'] = energy
+        return result
+
+    def update_form_data(self, force=True):
+        # Called from both the web-form and the battery thread (whilst streaming)
+        # Unless forced, only adds a reading once per Measurement Interval
+        with self.form_lock:
+            if not force and time.monotonic() - self.last_form < self.interval:
+                return
+            with timings.stage('form_update'):
+                self._update_form_data()
+            self.last_form = time.monotonic()
+            self.form_count += 1
+
+    def _update_form_data(self):
+        # Gather data for web-form update [keep up to MAX_HISTORY records, only show required history]
+        if self.readings >= MAX_HISTORY:
             self.history_volts.pop(0)
             self.history_current.pop(0)
             self.history_temp.pop(0)
@@ -141,7 +408,10 @@ class WebStats:
             self.readings += 1
         self.history_volts.append(self.battery.voltage)
         self.history_current.append(self.battery.current)
-        self.temperature = cpu.temperature
+        # CPU temperature and throttle status, cached by the shared collector
+        with timings.stage('sys_health'):
+            temperature, throttled = health.read()
+        self.temperature = temperature or 0.0
         self.history_temp.append(self.temperature)
 
         # Take average of available readings within number of readings taken
@@ -152,30 +422,20 @@ class WebStats:
             sum(self.history_current[len(self.history_current) - min(self.readings, self.averaging):]) \
             / min(self.readings, self.averaging)
 
-        if self.battery.battery_status == "CHARGING":
-            self.ext_power = "Yes, Charging at {}%".format(self.battery.battery_charge)
-        elif self.battery.battery_status == "FULL":
-            self.ext_power = "Yes, Battery FULL"
-        elif self.battery.battery_status == "DISCHARGING":
-            self.ext_power = "No, Battery at {}%".format(self.battery.battery_charge)
-        else:
-            self.ext_power = "BATTERY FAULT!!"
+        self.ext_power = self.power_text()
 
-        # Add data from vcgencmd into form
-        try:
-            cpu_status = subprocess.Popen(['vcgencmd', 'get_throttled'], stdout=subprocess.PIPE)
-            cpu_data = cpu_status.communicate()
-            cpu_status = int(cpu_data[0].decode().split("=")[1], 16)
-            if cpu_status == 0:
-                self.op_status = "CPU/GPU OK"
-            else:
-                self.op_status = cpu_data[0].decode().split("=")[1].strip()
-                self.op_status = self.op_status[:3] + " " + self.op_status[3:]
-        except (OSError, IndexError, ValueError):
+        # Add throttle status into form
+        if throttled is None:
             # Failed to extract info
             self.op_status = "Data Error"
+        elif throttled == 0:
+            self.op_status = "CPU/GPU OK"
+        else:
+            self.op_status = throttled_text(throttled)
+            self.op_status = self.op_status[:3] + " " + self.op_status[3:]
 
         if self.log_data:
+            log_start = time.perf_counter()
             self.log_file.write(time.strftime("%H:%M:%S", time.localtime()) +
                                 ", {:.2f}V, {:7.2f}mA, Ext Power: {}, Uptime: {}, Battery "
                                 "Time: {}, Temperature: {:.1f}, CPU: {}\n".format(self.battery.voltage,
@@ -186,12 +446,92 @@ class WebStats:
                                                                                   self.temperature,
                                                                                   self.op_status)
                                 )
-            self.log_file.flush()
+            timings.observe('log_write', time.perf_counter() - log_start)
 
         # Now plot history date to png file (for requested interval)
-        RR_Plotgraphs.rr_plots(self.history_volts[-self.history:],
-                               self.history_current[-self.history:],
-                               self.history_temp[-self.history:])
+        with timings.stage('render'):
+            rr_plots(self.history_volts[-self.history:],
+                     self.history_current[-self.history:],
+                     self.history_temp[-self.history:])
+
+
+def battery_colour(battery_status, battery_charge):
+    # Returns battery status colour and warning flag for the web-form
+    warning = False
+    if battery_status == "FULL":
+        colour = full
+    elif battery_status == "CHARGING":
+        if battery_charge < 10:
+            colour = charging[0]
+        else:
+            colour = charging[battery_charge // 20]
+    elif battery_status == "DISCHARGING":
+        if battery_charge < 10:
+            colour = discharging[0]
+            warning = True
+        else:
+            colour = discharging[battery_charge // 20]
+    else:
+        # Battery Fault
+        colour = fault
+        warning = True
+    return colour, warning
+
+
+def status_ok():
+    # Red Reactor available, as reported by the sampler process in worker mode
+    return web_info.status_ok() if WEB_MODE == 'worker' else rr_status_ok
+
+
+def page_version(data):
+    # Page/JSON version is the latest sample and form update of this (sampler) process
+    return "{}-{}-{}".format(data['Boot'], data['Sample'], data['Form'])
+
+
+def cache_headers(response, data):
+    # Browsers must check the version is current
+    response.set_etag(page_version(data), weak=True)
+    response.last_modified = data['Time']
+    response.cache_control.no_cache = True
+    return response
+
+
+def not_modified(data):
+    # Returns 304 response if the browser already has this version (If-None-Match or If-Modified-Since)
+    if is_resource_modified(request.environ, etag=page_version(data),
+                            last_modified=datetime.fromtimestamp(data['Time'], timezone.utc)):
+        return None
+    return cache_headers(Response(status=304), data)
+
+
+@app.after_request
+def compress(response):
+    # gzip pages, JSON and the SVG graph, for browsers that accept it
+    if response.status_code != 200 or response.mimetype not in GZIP_TYPES or \
+            'gzip' not in request.headers.get('Accept-Encoding', '') or 'Content-Encoding' in response.headers:
+        return response
+    response.direct_passthrough = False
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6, mtime=0))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    # Compressed copy is no longer byte for byte the same as the file
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def sampler_error(error):
+    # Worker mode only: sampler process not running (or restarting)
+    print("RR_WebMonitor Sampler Error:", error)
+    return "<h2><b>RR_WebMonitor sampler not available, please try again</b></h2>", 503
+
+
+if WEB_MODE == 'worker':
+    app.register_error_handler(RR_WebShared.SamplerError, sampler_error)
 
 
 @app.route('/favicon.ico')
@@ -203,16 +543,17 @@ def favicon():
 
 
 @app.route('/RedReactor/RR_Status.png')
+@app.route('/RedReactor/RR_Status.svg')
 def rr_status():
-    # Send status image
-    return send_from_directory(app.root_path, 'RR_Status.png')
+    # Send status image (PNG, or SVG in lite mode)
+    return send_from_directory(app.root_path, GRAPH_FILE)
 
 
 @app.route('/RedReactor/', methods=['POST', 'GET'])
 def rr_web_monitor():
     print("Updating Status Page")
     # If unable to read I2C, limit options to shutdown/reboot
-    if not rr_status_ok:
+    if not status_ok():
         return render_template("RR_WebMonitor - SysError.html")
 
     if request.method == 'POST':
@@ -230,46 +571,83 @@ def rr_web_monitor():
             web_info.change_settings(interval, history, averaging, log_data)
 
     # Now update form data values and create new graph
-    web_info.update_form_data()
-    warning = False
-
-    if web_info.battery.battery_status == "FULL":
-        colour = full
-    elif web_info.battery.battery_status == "CHARGING":
-        if web_info.battery.battery_charge < 10:
-            colour = charging[0]
-        else:
-            colour = charging[web_info.battery.battery_charge // 20]
-    elif web_info.battery.battery_status == "DISCHARGING":
-        if web_info.battery.battery_charge < 10:
-            colour = discharging[0]
-            warning = True
-        else:
-            colour = discharging[web_info.battery.battery_charge // 20]
-    else:
-        # Battery Fault
-        colour = fault
-        warning = True
-
-    web_stats = {'Interval': web_info.interval,
-                 'History': web_info.history,
-                 'Averaging': web_info.averaging,
-                 'Log_Data': "1" if web_info.log_data else "0",
-                 'Last_Volts': "{:.3f}".format(web_info.battery.voltage),
-                 'Last_Current': "{:.2f}".format(web_info.battery.current),
-                 'Average_Volts': "{:.3f}".format(web_info.average_volts),
-                 'Average_Current': "{:.2f}".format(web_info.average_current),
-                 'Op_Status': "{}".format(web_info.op_status),
-                 'Bat_Charge': web_info.battery.battery_charge,
-                 'Bat_Colour': colour,
-                 'Ext_Power': web_info.ext_power,
-                 'Ext_Warning': warning,
-                 'Temperature': web_info.temperature,
-                 'Up_Time': "hrs:".join(str(timedelta(seconds=web_info.up_time)).split(":")[:-1]),
-                 'Bat_Time': time.strftime("%Hhrs:%Mmins", time.gmtime(web_info.battery_time)),
-                 'Time_Now': time.strftime("%a, %d %b %Y %H:%M:%S", time.localtime())
-                 }
-    return render_template("RR_WebMonitor.html", web_stats=web_stats)
+    # Settings changes always redraw, page views only once per Measurement Interval
+    web_info.update_form_data(request.method == 'POST')
+    stats = web_info.form_data()
+    if request.method == 'GET':
+        cached = not_modified(stats)
+        if cached:
+            return cached
+    return cache_headers(Response(render_template("RR_WebMonitor.html", web_stats=stats)), stats)
+
+
+@app.route('/RedReactor/stream')
+def rr_stream():
+    # Server-Sent Events: pushes every new sample, and each form/graph update, to the browser
+    if not status_ok():
+        return Response(status=204)
+
+    def event_stream():
+        web_info.add_viewer(1)
+        try:
+            # Send current state immediately, then wait for each new sample
+            data = web_info.live_data()
+            sample = data['Sample']
+            form = data['Form']
+            yield "retry: 5000\nevent: sample\ndata: {}\n\n".format(dumps(data))
+            while not web_info.stop:
+                new_sample = web_info.wait_sample(sample, 15)
+                if new_sample == sample:
+                    # Keep-alive comment, also detects closed connections
+                    yield ": keep-alive\n\n"
+                    continue
+                sample = new_sample
+                data = web_info.live_data()
+                yield "event: sample\ndata: {}\n\n".format(dumps(data))
+                if data['Form'] != form:
+                    form = data['Form']
+                    yield "event: form\ndata: {}\n\n".format(dumps(web_info.form_data()))
+        finally:
+            # Runs when the browser disconnects
+            web_info.add_viewer(-1)
+
+    return Response(event_stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/RedReactor/history')
+def rr_history():
+    # JSON history downsampled to ?points=N (default is the graph budget)
+    # Use ?since=7d (or 12h, 30m, epoch seconds) for the long term history, else the graph history
+    if not status_ok():
+        return jsonify({}), 503
+    try:
+        points = min(max(int(request.args.get('points', RR_Downsample.PLOT_POINTS)), 3), 2000)
+        history = min(max(int(request.args['history']), 1), MAX_HISTORY) if 'history' in request.args else None
+        since = RR_History.parse_since(request.args['since']) if 'since' in request.args else None
+        until = RR_History.parse_since(request.args['until']) if 'until' in request.args else None
+    except ValueError:
+        return jsonify({'Error': 'Invalid points/history/since/until value'}), 400
+    method = 'minmax' if request.args.get('method') == 'minmax' else 'lttb'
+
+    # History only changes with each sample (long term) or form update (graph history)
+    live = web_info.live_data()
+    cached = not_modified(live)
+    if cached:
+        return cached
+    result = web_info.history_data(points, history, since, until, method)
+    if 'Error' in result:
+        return jsonify(result), 500
+    return cache_headers(jsonify(result), live)
+
+
+@app.route('/metrics')
+@app.route('/RedReactor/metrics')
+def rr_metrics():
+    # Prometheus scrape, returns the page encoded at the last sample
+    if not status_ok():
+        return Response(status=503)
+    return Response(web_info.metrics_data(), content_type=RR_Metrics.CONTENT_TYPE)
 
 
 @app.route('/stop/', methods=['POST'])
@@ -277,7 +655,7 @@ def rr_stop():
     print("STOP Request received!")
     if request.method == 'POST':
         # Stops update_bat_status thread if running
-        if rr_status_ok:
+        if status_ok():
             web_info.finish()
 
         if request.form['stop'] == "Restart":
@@ -300,7 +678,10 @@ discharging = ('255,0,0', '255,153,0', '204,204,0', '153,204,0', '102,255,51', '
 charging = ('204,0,153', '255,0,255', '204,51,255', '153,102,255', '102,102,255', '0,153,153')
 
 # Invoke the WebStats class to manage webpage data [not if Red Reactor failed to load]
-if rr_status_ok:
+# Workers use the sampler's WebStats instead, so only one process samples, logs and shuts down
+if WEB_MODE == 'worker':
+    web_info = RR_WebShared.RemoteStats(WEB_SOCKET)
+elif rr_status_ok:
     web_info = WebStats()
 
     # Run separate thread to update and monitor battery status for shutdown every 5s
@@ -308,9 +689,28 @@ if rr_status_ok:
     web_info_thread.start()
     time.sleep(0.5)
 
+
+def terminate(signum, frame):
+    # systemd stop: the battery thread writes out the log and history as it exits
+    print("RR_WebMonitor Stopping")
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    if rr_status_ok:
+        web_info.finish()
+    raise SystemExit(0)
+
+
 # Start the server framework
 if __name__ == "__main__":
     """Runs the Flask Server that handles incoming page requests"""
 
-    print("Starting WebServer for RR_WebMonitor Application")
-    app.run(host="0.0.0.0", port=5000, debug=False)
+    if WEB_MODE != 'worker':
+        signal.signal(signal.SIGTERM, terminate)
+        # kill -USR1 <pid> prints where the time goes
+        timings.dump_on_signal()
+
+    if WEB_MODE == 'sampler':
+        print("Starting RR_WebMonitor Sampler for web server workers on", WEB_SOCKET)
+        RR_WebShared.SamplerServer(web_info if rr_status_ok else None, WEB_SOCKET).serve_forever()
+    else:
+        print("Starting WebServer for RR_WebMonitor Application")
+        app.run(host="0.0.0.0", port=5000, debug=False)
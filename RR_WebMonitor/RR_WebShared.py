@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+*** RED REACTOR - Copyright (c) 2024
+*** Author: Pascal Herczog
+
+*** This code is designed for the RED REACTOR Raspberry Pi Battery Power Supply
+*** Example code provided without warranty
+*** Shares one RR_WebMonitor sampler between many web server workers over a local Unix socket
+
+# The sampler process owns the Red Reactor (I2C), the log, the history store and the shutdown watcher
+# Each worker uses RemoteStats in place of WebStats, one JSON line request/reply per call
+# e.g. {"cmd": "live"} -> {"reply": {...}}
+
+*** You may use/modify only for use with the RED REACTOR product
+*** Filename: RR_WebShared.py
+*** PythonVn: 3.8, 32-bit
+*** Date: October 2024
+"""
+
+# Import Libraries
+import os
+import socket
+import socketserver
+import time
+from json import dumps, loads
+
+# Default socket, in the RR_WebMonitor folder (WorkingDirectory of both services)
+SOCKET_FILE = "RR_WebMonitor.sock"
+
+# Seconds to wait for a sampler reply ('wait' requests add their own wait time)
+TIMEOUT = 5
+
+# Seconds a worker keeps the sampler's Red Reactor status before asking again (e.g. after a sampler restart)
+STATUS_TTL = 30
+
+
+class SamplerError(OSError):
+    """The sampler is not running, replied with an error, or closed the connection without a reply
+    Handled with a 503 in the workers
+    """
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            request = loads(self.rfile.readline())
+            reply = {'reply': self.server.dispatch(request.pop('cmd'), **request)}
+        except Exception as error:
+            # Always reply, e.g. sqlite3.Error or OSError from the history, plot or log code
+            reply = {'error': "{}: {}".format(type(error).__name__, error)}
+        self.wfile.write(dumps(reply).encode() + b"\n")
+
+
+class SamplerServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves the sampler's WebStats to the workers, stats is None if the Red Reactor failed to load"""
+
+    daemon_threads = True
+
+    def __init__(self, stats, socket_file=SOCKET_FILE):
+        self.stats = stats
+        # Remove socket left by a previous run
+        if os.path.exists(socket_file):
+            os.remove(socket_file)
+        super().__init__(socket_file, _Handler)
+        # Workers may run as a different user (e.g. www-data) in the same group
+        os.chmod(socket_file, 0o660)
+
+    def dispatch(self, cmd, **args):
+        stats = self.stats
+        if cmd == 'status':
+            return {'ok': stats is not None}
+        if stats is None:
+            raise ValueError("Red Reactor not available")
+        if cmd == 'live':
+            return stats.live_data()
+        if cmd == 'form':
+            return stats.form_data()
+        if cmd == 'update':
+            stats.update_form_data(args['force'])
+            return {}
+        if cmd == 'settings':
+            stats.change_settings(args['interval'], args['history'], args['averaging'], args['log_data'])
+            return {}
+        if cmd == 'wait':
+            return {'sample': stats.wait_sample(args['sample'], args['timeout']), 'stop': stats.stop}
+        if cmd == 'viewer':
+            stats.add_viewer(args['count'])
+            return {}
+        if cmd == 'history':
+            return stats.history_data(**args)
+        if cmd == 'metrics':
+            return stats.metrics_data().decode()
+        if cmd == 'finish':
+            stats.finish()
+            return {}
+        raise ValueError("Unknown command: {}".format(cmd))
+
+
+class RemoteStats:
+    """WebStats interface for the web server workers, forwarded to the sampler process"""
+
+    def __init__(self, socket_file=SOCKET_FILE):
+        self.socket_file = socket_file
+        self.stop = False
+        self.ok = None
+        self.ok_time = 0
+
+    def _call(self, cmd, extra_time=0, **args):
+        # One connection per call, so safe across worker forks and threads
+        args['cmd'] = cmd
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.settimeout(TIMEOUT + extra_time)
+                client.connect(self.socket_file)
+                client.sendall(dumps(args).encode() + b"\n")
+                line = client.makefile('rb').readline()
+        except OSError as error:
+            raise SamplerError("RR_WebShared sampler not available: {}".format(error)) from error
+        if not line:
+            raise SamplerError("RR_WebShared sampler closed the connection without a reply")
+        reply = loads(line)
+        if 'error' in reply:
+            raise SamplerError("RR_WebShared sampler error: {}".format(reply['error']))
+        return reply['reply']
+
+    def status_ok(self):
+        # Asked again every STATUS_TTL seconds, as the sampler may have restarted with or without the Red Reactor
+        if self.ok is None or time.monotonic() - self.ok_time >= STATUS_TTL:
+            try:
+                self.ok = self._call('status')['ok']
+                self.ok_time = time.monotonic()
+            except OSError:
+                self.ok = None
+                return False
+        return self.ok
+
+    def live_data(self):
+        return self._call('live')
+
+    def form_data(self):
+        return self._call('form')
+
+    def update_form_data(self, force=True):
+        self._call('update', force=force)
+
+    def change_settings(self, interval, history, averaging, log_data):
+        self._call('settings', interval=interval, history=history, averaging=averaging, log_data=log_data)
+
+    def wait_sample(self, last_sample, timeout):
+        # Blocks in the sampler, so allow for the wait time as well
+        reply = self._call('wait', timeout, sample=last_sample, timeout=timeout)
+        self.stop = reply['stop']
+        return reply['sample']
+
+    def add_viewer(self, count):
+        self._call('viewer', count=count)
+
+    def history_data(self, points, history=None, since=None, until=None, method='lttb'):
+        return self._call('history', points=points, history=history, since=since, until=until, method=method)
+
+    def metrics_data(self):
+        return self._call('metrics').encode()
+
+    def finish(self):
+        self._call('finish')
@@ -21,6 +21,15 @@ from ina219 import DeviceRangeError  # Handle reading errors
 import time  # Used to sleep between readings
 import threading
 
+# Stage timings, dump with kill -USR1 <pid>
+from RR_Timing import timings, Ticker
+
+# Time limited I2C reads with retries, and a watchdog for missing samples
+from RR_Watchdog import BoundedI2C, Watchdog
+
+# Shares the I2C bus with other Red Reactor monitors
+from RR_I2CLock import i2c_lock
+
 # Use this if forcing shutdown
 # import subprocess
 
@@ -92,13 +101,13 @@ class RedReactor:
         self.stop_reader = False
 
         # Initialise system
-        # Set measurement config, ina class will optimise readings for resolution
-        self.ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, busnum=1)
-        self.ina.configure(self.ina.RANGE_16V)
+        # Reads that hang or fail are retried, re-opening the bus with connect()
+        self.ina = BoundedI2C(self.connect)
 
         # Initialise battery status and reading history [last element is most recent]
         # Note that the bus voltage is that on the load side of the shunt resistor
-        self.voltage = self.ina.voltage()
+        with i2c_lock:
+            self.voltage = self.ina.voltage()
         self.history = [self.voltage, self.voltage, self.voltage, self.voltage]
 
         self.current = 0
@@ -112,27 +121,48 @@ class RedReactor:
         # ina.power() - returns the bus power consumption in mW
         # ina.shunt_voltage() - return shunt voltage value in mV
 
+        # Read on a fixed schedule, however long each read takes
+        self.ticker = Ticker(self.measure_interval, 'sample')
+
+        # Reports if no good reading has been taken for several intervals
+        self.watchdog = Watchdog(self.measure_interval, escalate=self.stalled)
+        self.watchdog.start()
+
         # Now run the battery reader in a separate thread for continuous monitoring
         # Run battery monitoring in separate thread
         self.battery_reader_thread = threading.Thread(target=self.battery_reader, name="BatteryMonitor")
         self.battery_reader_thread.start()
 
+    @staticmethod
+    def connect():
+        # Set measurement config, ina class will optimise readings for resolution
+        ina = INA219(SHUNT_OHMS, MAX_EXPECTED_AMPS, busnum=1)
+        ina.configure(ina.RANGE_16V)
+        return ina
+
     def change_interval(self, interval):
         self.measure_interval = interval
+        self.ticker.period = interval
+        self.watchdog.period = interval
 
     def stop_reading(self):
         self.stop_reader = True
+        self.watchdog.stop = True
 
-    def battery_reader(self):
-        """
-        Runs indefinitely or until triggered to shut down or asked to stop_reading
-        Should be called as a thread so user SW can run as well
-        """
+    @staticmethod
+    def stalled(seconds):
+        # Called by the watchdog, the shutdown check can't run without readings
+        print("RED REACTOR: WARNING no battery reading for {:.0f}s".format(seconds))
 
-        while not self.stop_reader:
+    def read_battery(self):
+        """Reads the battery and updates status and charge, returns the average voltage"""
 
-            # Read battery status
-            # This is the sum of the bus voltage and shunt voltage
+        # Wake up INA219 IC, it sleeps between readings
+        self.ina.wake()
+
+        # Read battery status
+        # This is the sum of the bus voltage and shunt voltage
+        with timings.stage('i2c_read'):
             self.voltage = self.ina.voltage()
             try:
                 # Returns the bus current in milliamps (mA), or exception if exceed limit
@@ -159,50 +189,73 @@ class RedReactor:
             except DeviceRangeError as battery_error:
                 # Current out of device range with specified shunt resistor
                 print("RED REACTOR: Measurement Range Error:\n", battery_error)
+                timings.count('range_error')
                 # Max shunt voltage is 0.32v but at 0.05 Ohms this would be 6.4 Amps
                 self.current = 6400.0
                 self.power = self.voltage * abs(self.current)
                 self.shuntv = 0.32
                 self.battery_status = "FAULT"
 
-            # Update read history, maintains last 4 readings incl. this one
-            self.history.pop(0)
-            self.history.append(self.voltage)
-
-            # Calculate battery charge as percentage
-            average_volt = (self.history[0] * self.coefficients[0]
-                            + self.history[1] * self.coefficients[1]
-                            + self.history[2] * self.coefficients[2]
-                            + self.history[3] * self.coefficients[3])
-            # Down to ~3v an 18650 discharge curve is more or less linear
-            # If you choose to model this more accurately, account for current peaks
-            # Set Charge Level (except for FAULT)
-            if self.battery_status == "CHARGING":
-                # Adjust charge level w.r.t. charging state
-                self.battery_charge = \
-                    min(100, int(((average_volt - BATTERY_VMIN) / (BATTERY_VMAX + BATTERY_CHRG - BATTERY_VMIN)) * 100))
-            elif self.battery_status in ['DISCHARGING', 'FULL']:
-                # At end of charge cycle battery voltage will drop slightly as charger no longer driving
-                self.battery_charge = \
-                    min(100, int(((average_volt - BATTERY_VMIN) / (BATTERY_VMAX - BATTERY_DCHG - BATTERY_VMIN)) * 100))
-            # If system goes below VMIN, show 0%
-            if self.battery_charge < 0:
-                self.battery_charge = 0
-
-            # STOP If average readings below VMIN and still discharging
-            if average_volt < BATTERY_VMIN and self.battery_status == "DISCHARGING":
-                # Once set, it cannot be reset without a proper shutdown
-                self.shutdown = True
-                break
-
-            # Put I2C device to sleep during reporting interval
-            self.ina.sleep()
-            # Check every second for user request to exit
-            for waiting in range(0, self.measure_interval):
-                time.sleep(1)
-                if self.stop_reader:
+        with timings.stage('classify'):
+            average_volt = self.classify()
+        return average_volt
+
+    def classify(self):
+        # Update read history, maintains last 4 readings incl. this one
+        self.history.pop(0)
+        self.history.append(self.voltage)
+
+        # Calculate battery charge as percentage
+        average_volt = (self.history[0] * self.coefficients[0]
+                        + self.history[1] * self.coefficients[1]
+                        + self.history[2] * self.coefficients[2]
+                        + self.history[3] * self.coefficients[3])
+        # Down to ~3v an 18650 discharge curve is more or less linear
+        # If you choose to model this more accurately, account for current peaks
+        # Set Charge Level (except for FAULT)
+        if self.battery_status == "CHARGING":
+            # Adjust charge level w.r.t. charging state
+            self.battery_charge = \
+                min(100, int(((average_volt - BATTERY_VMIN) / (BATTERY_VMAX + BATTERY_CHRG - BATTERY_VMIN)) * 100))
+        elif self.battery_status in ['DISCHARGING', 'FULL']:
+            # At end of charge cycle battery voltage will drop slightly as charger no longer driving
+            self.battery_charge = \
+                min(100, int(((average_volt - BATTERY_VMIN) / (BATTERY_VMAX - BATTERY_DCHG - BATTERY_VMIN)) * 100))
+        # If system goes below VMIN, show 0%
+        if self.battery_charge < 0:
+            self.battery_charge = 0
+        return average_volt
+
+    def battery_reader(self):
+        """
+        Runs indefinitely or until triggered to shut down or asked to stop_reading
+        Should be called as a thread so user SW can run as well
+        """
+
+        while not self.stop_reader:
+
+            try:
+                # Another monitor mustn't put the device to sleep during this read
+                with i2c_lock:
+                    with timings.stage('sample'):
+                        average_volt = self.read_battery()
+
+                    # Put I2C device to sleep during reporting interval
+                    self.ina.sleep()
+            except OSError as error:
+                # Still failing after retries, keep the last readings and try again next interval
+                print("RED REACTOR: I2C read error:", error)
+            else:
+                self.watchdog.kick()
+
+                # STOP If average readings below VMIN and still discharging
+                if average_volt < BATTERY_VMIN and self.battery_status == "DISCHARGING":
+                    # Once set, it cannot be reset without a proper shutdown
+                    self.shutdown = True
                     break
-            self.ina.wake()
+
+            # Check every second for user request to exit
+            self.ticker.wait(lambda: self.stop_reader)
 
         if self.shutdown:
             print("Battery Monitor: Exiting on battery voltage warning")
@@ -232,6 +285,8 @@ if __name__ == "__main__":
 
     # Initialise RedReactor and set measurement interval
     battery = RedReactor(report_interval)
+    # Show where the time goes with kill -USR1 <pid>
+    timings.dump_on_signal()
 
     # Your application can access the battery status at any time
     print(" Vbat,   I(mA), Power(mW), Vshunt, CHARGE, STATUS ")
@@ -253,3 +308,4 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         battery.stop_reading()
         print("UI: User shutdown request detected")
+    print(timings.report())